@@ -3,7 +3,11 @@ import numpy as np
 import math
 import glob
 
+import os
+import probStore
+from frameCache import FrameCache
 from Matcher import Matcher
+from prefetch import loadFrame
 
 extension = '.png'
 NUM_LOCATIONS = 7
@@ -134,29 +138,11 @@ def illustrateProb(circle, arrowsL, probsL):
             setArrow(this_circles_arrows, j, 1, color, mult)
 
 def readProb(filename):
-    file = open(filename, 'r')
-    raw_content = file.read().split('\n')[:-1]
-    raw_chunks = [raw_content[i:i+2] for i in range(0, len(raw_content), 2)]
-    raw_probL = [raw_chunks[i:i+NUM_LOCATIONS] for i in range(0, len(raw_chunks), NUM_LOCATIONS)]
-    probD = {}
-    counter = 0
-    for prob in raw_probL:
-        content = []
-        for location in prob:
-            totalMatches = float(location[0])
-            probabilities = list(map(float, location[1].replace('[','').replace(']','').split(',')))
-            content.append([totalMatches, probabilities])
-        probD[str(counter).zfill(4)] = content
-        counter += 1
-    return probD
+    return probStore.readFrames(filename)
 
 def readBestGuess(filename):
     '''this function reads the list of best guesses of the robot's position at every position'''
-    file = open(filename, 'r')
-    content = file.read().split('\n')[:-1]
-    content = list(map(int, content))
-    bestGuesses = [[content[x], content[x+1]] for x in range(len(content) - 1 ) [::2]    ]
-    return bestGuesses
+    return probStore.readFrames(filename).tolist()
 
 def readCommand(filename):
     '''this function reads the command list from the robot'''
@@ -173,12 +159,6 @@ def readCoord(filename):
     coordinates = [list(map(int, coord.split(','))) for coord in content]
     return coordinates
 
-def Laplacian(imagePath):
-    ''' this function calculates the blurriness factor'''
-    img = cv2.imread(imagePath, 0)
-    var = cv2.Laplacian(img, cv2.CV_64F).var()
-    return var
-
 def initializeCircle():
     circles = [None] * NUM_LOCATIONS
     for i in range(NUM_LOCATIONS):
@@ -194,9 +174,11 @@ for circle in circles:
     arrows.append(getArrows(circle, 25))
 
 commandList = readCommand('commands.txt')
-probDict = readProb('out.txt')
+probs = readProb('out.bin')
+# Blur factors are shared with analyzer runs that use the frame cache
+cache = FrameCache('cache') if os.path.isdir('cache') else None
 coordinates = readCoord('coord.txt')
-bestGuess = readBestGuess('bestGuess.txt')
+bestGuess = readBestGuess('bestGuess.bin')
 
 # Outputting the Probability
 
@@ -207,10 +189,10 @@ for imagePath in glob.glob('cam1_img' + '/*' + extension):
     groundTruth = cv2.imread(imagePath.replace('cam1_img', 'cam2_img'))
 
     # Read matching data
-    p = probDict[imagePath.replace('cam1_img/', '').replace(extension, '')]
+    p = probStore.circleList(probs[int(imagePath.replace('cam1_img/', '').replace(extension, ''))])
 
     # Accounting for Blur factor 
-    blurFactor = Laplacian(imagePath)
+    blurFactor = loadFrame(imagePath, cache=cache).blur
     illustrateProb(circles, arrows, p)
 
     bestCircleIndex = bestGuess[int(imagePath.replace('cam1_img/', '').replace(extension, ''))][0]
@@ -20,35 +20,188 @@ Usage:
 
 import cv2
 import numpy as np
+import copy
 import glob
+import multiprocessing
+import os
 import time
 from matplotlib import pyplot as plt
-from sklearn.externals import joblib
-from search import Searcher
-
-from scipy.cluster.vq import *
-
-from sklearn import preprocessing
+from search import Searcher, ColorIndex
+import bow
+import frameCache
+import prefetch
+from pano import Panorama
+from featureIndex import FeatureIndex, createDetector, detectFeatures, packKeypoints, unpackKeypoints
 
 extension = '.png'
 
+def trainLocation(args):
+    '''
+    Trains the dictionary of one location in a writeIndices worker process.
+    '''
+    location, numWords, tree, branching, depth, trainPerImage = args
+    cv2.setNumThreads(1)
+    # Worker processes cannot start their own pools for the tree branches
+    vocabularyTree = bow.VocabularyTree(branching, depth, n_jobs=1) if tree else None
+    image_paths = sorted(glob.glob(location + '/*' + '.png'))
+    bow.trainIndex(image_paths, location + ('_tree.pkl' if tree else '.pkl'), numWords, vocabularyTree, trainPerImage)
+    return location
+
 class Matcher(object):
 
     ######################
     ### Initialization ###
     ######################
 
-    def __init__(self, algorithm, index=None, width=800, height=600):
+    def __init__(self, algorithm, index=None, width=800, height=600, vote=False, lsh=False, cascade=None,
+                 budget=None, grid=None, cache=None, tree=False, candidates=10, candidateMargin=None,
+                 compressed=False, pcaDims=64, subspaces=16, rerank=50, probes=8):
         self.w = width
         self.h = height
         self.alg = algorithm
         self.index = index
         self.numWords = 10000
+        self.tree = tree
+        self.branching = 10
+        self.depth = 4
+        self.trainPerImage = None
+        self.vote = vote
+        self.voteNeighbours = 10
+        self.compressed = compressed
+        self.pcaDims = pcaDims
+        self.subspaces = subspaces
+        self.rerank = rerank
+        self.probes = probes
+        self.lsh = lsh
+        self.mapIndexPath = 'map/map.pkl'
+        self.cascade = cascade
+        self.candidates = candidates
+        self.candidateMargin = candidateMargin
+        self.cascadeIndices = {}
+        self.cascadeDetector = None
+        self.budget = budget
+        self.grid = grid
+        self.cache = cache
+        self.detector = self.createDetector()
+        self.queryFeatures = None
+        self.queryHistogram = None
+        self.queryDigest = None
+        self.mapScores = None
+        self.cascadeCandidates = None
+
+    def createDetector(self):
+        '''
+        Creates the feature detector shared by the query and the map.
+        BOW uses SIFT descriptors; color matching needs no detector.
+        '''
+        return createDetector(self.alg)
+
+    def preprocess(self, image):
+        '''
+        Smooths a camera frame and resizes it to the matching resolution.
+        '''
+        image = cv2.bilateralFilter(image, 9, 75, 75)
+        return cv2.resize(image, (self.w, self.h))
+
+    def preprocessKey(self):
+        '''
+        Describes preprocess, for the keys of cached query images.
+        '''
+        return ('bilateralFilter', 9, 75, 75, 'resize', self.w, self.h, cv2.__version__)
 
     def setQuery(self, imagePath):
-        self.image = cv2.imread(imagePath)
-        self.image = cv2.bilateralFilter(self.image, 9, 75, 75)
-        self.image = cv2.resize(self.image, (self.w, self.h))
+        if self.cache is None:
+            self.setQueryImage(self.preprocess(cv2.imread(imagePath)))
+        else:
+            self.setQueryImage(prefetch.loadFrame(imagePath, self.preprocess, self.cache, self.preprocessKey()).query)
+
+    def setQueryImage(self, image):
+        '''
+        Sets an already preprocessed query image, e.g. one prepared by
+        prefetch.FramePrefetcher.
+        '''
+        self.image = image
+        self.queryFeatures = None
+        self.queryHistogram = None
+        self.queryDigest = None
+        self.mapScores = None
+        self.cascadeCandidates = None
+
+    def cacheKey(self, *params):
+        '''
+        Frame cache key of an artifact of the query image.
+        '''
+        if self.queryDigest is None:
+            self.queryDigest = frameCache.digest(self.image)
+        return self.cache.key(self.queryDigest, *params)
+
+    def getQueryFeatures(self):
+        '''
+        Returns the keypoints and descriptors of the query image. They are
+        extracted once per query and reused for every map image and location,
+        and with a frame cache they are only extracted on the first run.
+        '''
+        if self.queryFeatures is None and self.cache is None:
+            self.queryFeatures = detectFeatures(self.detector, self.image, self.budget, self.grid)
+        elif self.queryFeatures is None:
+            key = self.cacheKey('features', self.alg, self.budget, self.grid, cv2.__version__)
+            stored = self.cache.get(key)
+            if stored is None:
+                kp, des = detectFeatures(self.detector, self.image, self.budget, self.grid)
+                if des is None:
+                    self.cache.put(key, keypoints=packKeypoints(kp))
+                else:
+                    self.cache.put(key, keypoints=packKeypoints(kp), descriptors=des)
+                self.queryFeatures = kp, des
+            else:
+                self.queryFeatures = unpackKeypoints(stored['keypoints']), stored.get('descriptors')
+        return self.queryFeatures
+
+    def getQueryHistogram(self):
+        '''
+        The color histogram of the query image, computed once per query.
+        '''
+        if self.queryHistogram is None and self.cache is None:
+            self.queryHistogram = self.createHistogram(self.image)
+        elif self.queryHistogram is None:
+            key = self.cacheKey('histogram', (8, 8, 8))
+            stored = self.cache.get(key)
+            if stored is None:
+                self.queryHistogram = self.createHistogram(self.image)
+                self.cache.put(key, histogram=self.queryHistogram)
+            else:
+                self.queryHistogram = stored['histogram']
+        return self.queryHistogram
+
+    def prepareQuery(self):
+        '''
+        Computes everything about the query that is shared between
+        locations, so that copies made by forLocation can match
+        concurrently without recomputing or racing on it.
+        '''
+        if self.detector is not None:
+            self.getQueryFeatures()
+        if self.alg == 'Color' or self.cascade == 'Color':
+            self.getQueryHistogram()
+        if self.alg == 'MapBOW' and self.mapScores is None:
+            kp, des = self.getQueryFeatures()
+            self.mapScores = bow.loadMapIndex(self.mapIndexPath).score(des)
+        if self.cascade is not None and self.cascadeCandidates is None:
+            self.cascadeCandidates = self.rankCandidates()
+
+    def forLocation(self, directory, index=None):
+        '''
+        Returns a copy of the matcher set to another location, sharing the
+        query. Copies of one matcher can run in separate threads; OpenCV
+        releases the GIL while matching.
+        '''
+        located = copy.copy(self)
+        located.setDirectory(directory)
+        if self.alg == 'Color':
+            located.setColorIndex(index)
+        else:
+            located.setIndex(index)
+        return located
 
     def setDirectory(self, directory):
         self.data = directory
@@ -75,17 +228,10 @@ class Matcher(object):
 
     def createColorIndex(self):
         '''
-        Creates dictionary with keys as image names and histograms as values.
+        Creates the color index of the current directory: a matrix of
+        histograms with the image names, reloaded from disk when unchanged.
         '''
-        index = {}
-
-        for imagePath in glob.glob(self.data + "/*" + extension):
-            filename = imagePath[imagePath.rfind("/") + 1:]
-            image = cv2.imread(imagePath)
-            # print('\t%s' % imagePath)
-            features = self.createHistogram(image)
-            index[filename] = features
-        return index
+        return ColorIndex(self.data).update(self.createHistogram, cv2.imread)
 
     def colorSearch(self):
         '''
@@ -93,7 +239,7 @@ class Matcher(object):
         Results are in the format (chi-squared distance, image name).
         '''
         searcher = Searcher(self.colorIndex)
-        queryFeatures = self.createHistogram(self.image)
+        queryFeatures = self.getQueryHistogram()
 
         results = searcher.search(queryFeatures)
         return results
@@ -103,64 +249,120 @@ class Matcher(object):
     ### Bag-of-Words Matching ###
     #############################
 
-    def createIndex(self, trainingPath):
-        desc = cv2.xfeatures2d.SIFT_create()
-        train_des_list = []
-        numWords = self.numWords
-        image_paths = glob.glob(trainingPath + '/*' + '.png')
-        # Extract the descriptors from the maps and store them 
-        for imagePath in glob.glob(trainingPath + '/*' + '.png'):
-            print(imagePath)
-            image = cv2.imread(imagePath)
-            kp, des = desc.detectAndCompute(image, None)
-            train_des_list.append((imagePath, des))
-
-        # Stack them all in a numpy array
-        train_descriptors = train_des_list[0][1]
-        for image_path, descriptor in train_des_list[1:]:
-            train_descriptors = np.vstack((train_descriptors, descriptor))
-
-        # Perform K-means clustering?
-        voc, variance = kmeans(train_descriptors, numWords, 1)
-
-        # Calculate histogram of features for the Training SET
-        im_features = np.zeros((len(image_paths), numWords), "float32")
-        for i in range(len(glob.glob(trainingPath + '/*' + '.png'))):
-            words, distance = vq(train_des_list[i][1], voc)
-            for w in words:
-                im_features[i][w] += 1
-
-        # Perform Tf-idf vectorization for Training set
-        nbr_occurences = np.sum((im_features > 0) * 1, axis = 0)
-        idf = np.array(np.log((1.0*len(image_paths)+1) / (1.0*nbr_occurences + 1)), 'float32')
-
-        # Perform L2 normalization
-        im_features = im_features*idf
-        im_features = preprocessing.normalize(im_features, norm='l2')
-
-        joblib.dump((im_features, image_paths, idf, numWords, voc), trainingPath + ".pkl", compress=3)
-
-    def writeIndices(self):
-        for mapp in glob.glob('map/*/'):
-            self.createIndex(mapp[:-1])
+    def createIndex(self, trainingPath, tree=None):
+        '''
+        Trains the dictionary of a location and writes it to <location>.pkl.
+        With tree set, the vocabulary is a VocabularyTree of the Matcher's
+        branching and depth instead, written to <location>_tree.pkl. tree
+        defaults to the Matcher's own setting.
+        Descriptors are streamed to disk, and at most trainPerImage
+        descriptors of each image are clustered if it is set.
+        '''
+        tree = self.tree if tree is None else tree
+        image_paths = sorted(glob.glob(trainingPath + '/*' + '.png'))
+        vocabularyTree = bow.VocabularyTree(self.branching, self.depth) if tree else None
+        bow.trainIndex(image_paths, trainingPath + ('_tree.pkl' if tree else '.pkl'),
+                       self.numWords, vocabularyTree, self.trainPerImage)
+
+    def writeIndices(self, tree=None, workers=1):
+        '''
+        Trains the dictionaries of every location. With more than one worker,
+        locations are trained in a process pool and each dictionary is
+        written as soon as its location is done.
+        '''
+        tree = self.tree if tree is None else tree
+        locations = [mapp[:-1] for mapp in glob.glob('map/*/')]
+        if workers <= 1:
+            for location in locations:
+                self.createIndex(location, tree)
+            return
+
+        settings = (self.numWords, tree, self.branching, self.depth, self.trainPerImage)
+        pool = multiprocessing.Pool(workers)
+        try:
+            done = 0
+            for location in pool.imap_unordered(trainLocation, [(location,) + settings for location in locations]):
+                done += 1
+                print('Trained %s (%d/%d locations)' % (location, done, len(locations)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def writeMapIndex(self):
+        '''
+        Trains a single dictionary for the whole map, used by MapBOW.
+        '''
+        locations = sorted(mapp[:-1] for mapp in glob.glob('map/*/'))
+        bow.trainMapIndex(locations, self.mapIndexPath, self.numWords, extension, self.trainPerImage)
 
     def createFeatureIndex(self):
         '''
-        Creates a dictionary with keys as image paths and values as keypoints and descriptors
+        Loads the on-disk feature index of the current directory, extracting
+        features only for map images that changed since it was written.
+        Indexing by image path gives the keypoints and descriptors. The
+        keypoint budget applies to the map as it does to the query.
         '''
-        if self.alg == 'SURF':
-            desc = cv2.xfeatures2d.SURF_create()
-        elif self.alg == 'SIFT':
-            desc = cv2.xfeatures2d.SIFT_create()
-        else:
-            desc = cv2.ORB_create()
-        index = {}
-        for imagePath in glob.glob(self.data + '/*' + extension):
-            image = cv2.imread(imagePath)
-            kp, des = desc.detectAndCompute(image, None)
-            index[imagePath] = (kp, des)
+        return FeatureIndex(self.data, self.alg, budget=self.budget, grid=self.grid).update(self.detector)
 
-        return index
+    ###############
+    ### Cascade ###
+    ###############
+
+    def cascadeScores(self):
+        '''
+        Scores every map image with the cheap stage of the cascade, higher
+        being more similar. Returns the image paths and their scores.
+        '''
+        if self.cascade == 'MapBOW':
+            index = bow.loadMapIndex(self.mapIndexPath)
+            return index.image_paths, index.score(self.cascadeDescriptors())
+
+        # Color: inverted chi-squared distance to every histogram of the map
+        imagePaths, distances = [], []
+        queryFeatures = self.getQueryHistogram()
+        for location in sorted(mapp[:-1] for mapp in glob.glob('map/*/')):
+            if location not in self.cascadeIndices:
+                self.cascadeIndices[location] = ColorIndex(location).update(self.createHistogram, cv2.imread)
+            colorIndex = self.cascadeIndices[location]
+            imagePaths.extend(location + '/' + name for name in colorIndex.names)
+            distances.append(Searcher(colorIndex).chisquared(colorIndex.features, queryFeatures))
+        return imagePaths, 200. / np.maximum(np.concatenate(distances), 1e-10)
+
+    def cascadeDescriptors(self):
+        '''
+        SIFT descriptors of the query for the MapBOW stage. The map-wide
+        dictionary is trained on SIFT whatever the algorithm, so SURF and
+        ORB extract them with a separate detector.
+        '''
+        if self.alg == 'SIFT':
+            return self.getQueryFeatures()[1]
+        if self.cascadeDetector is None:
+            self.cascadeDetector = createDetector('SIFT')
+        kp, des = detectFeatures(self.cascadeDetector, self.image, self.budget, self.grid)
+        return des
+
+    def cascadeFilter(self, imagePaths):
+        '''
+        The images among imagePaths that the cascade keeps for verification,
+        all of them without a cascade.
+        '''
+        if self.cascade is None:
+            return imagePaths
+        if self.cascadeCandidates is None:
+            self.cascadeCandidates = self.rankCandidates()
+        return [imagePath for imagePath in imagePaths if imagePath in self.cascadeCandidates]
+
+    def rankCandidates(self):
+        '''
+        Returns the set of map images to verify with the feature matcher: the
+        self.candidates best images of the cheap stage, or only those scoring
+        within candidateMargin of the best one when that is set.
+        '''
+        imagePaths, scores = self.cascadeScores()
+        order = np.argsort(-np.asarray(scores), kind='stable')[:self.candidates]
+        if self.candidateMargin is not None and len(order):
+            order = order[scores[order] >= (1 - self.candidateMargin) * scores[order[0]]]
+        return set(imagePaths[i] for i in order)
 
     #################################
     ### Image Matching Algorithms ###
@@ -172,9 +374,7 @@ class Matcher(object):
         Matching is done through Brute-Force.
         '''
 
-        orb = cv2.ORB_create()
-
-        kp1, des1 = orb.detectAndCompute(self.image, None)
+        kp1, des1 = self.getQueryFeatures()
         kp2, des2 = self.index[imagePath]
 
         bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
@@ -188,10 +388,23 @@ class Matcher(object):
                 singlePointColor=None, 
                 flags=2)
 
-            image = cv2.drawMatches(self.image, kp1, training, kp2, matches, None, **draw_params)
+            training = cv2.imread(imagePath)
+            image = cv2.drawMatches(self.image, kp1, training, unpackKeypoints(kp2), matches, None, **draw_params)
             plt.imshow(image), plt.show()
 
-        return len(good)
+        return len(matches)
+
+    def ORBBatchMatch(self, imagePaths):
+        '''
+        Matches the query against every image of the location in one batched
+        Hamming distance computation, with the same cross-checked matches as
+        ORBMatch. With lsh set, only candidates from a multi-probe LSH index
+        are compared.
+        Returns the number of matches for each of the given image paths.
+        '''
+        kp1, des1 = self.getQueryFeatures()
+        votes = self.index.hammingMatcher(self.lsh).match(des1)
+        return [int(votes[self.index.lookup[os.path.basename(imagePath)]]) for imagePath in imagePaths]
 
     def SURFMatch(self, imagePath, display_results=False):
         '''
@@ -200,12 +413,10 @@ class Matcher(object):
         Lowe's ratio test is applied.
         '''
 
-        surf = cv2.xfeatures2d.SURF_create()
-
-        kp1, des1 = surf.detectAndCompute(self.image, None)
+        kp1, des1 = self.getQueryFeatures()
         if not self.index:
             training = cv2.imread(imagePath)
-            kp2, des2 = surf.detectAndCompute(training, None)
+            kp2, des2 = detectFeatures(self.detector, training, self.budget, self.grid)
         else:
             kp2, des2 = self.index[imagePath]
 
@@ -231,32 +442,21 @@ class Matcher(object):
 
     def BOWMatch(self, indexPath):
         '''the query's score against an individual index'''
-        # start = time.time()
-        query_des_list = []
-        im_features, image_paths, idf, numWords, voc = joblib.load(indexPath)
-        numWords = self.numWords
-
-        desc = cv2.xfeatures2d.SIFT_create()
-        # Extract the descriptors from the query 
-        query = self.image
-        kp, des = desc.detectAndCompute(query, None)
-        query_des_list.append((query, des))
-
-        # Stack query descriptors in a numpy array
-        query_descriptors = query_des_list[0][1]
+        # Dictionaries stay loaded and the query descriptors are shared across locations
+        kp, des = self.getQueryFeatures()
+        return bow.loadIndex(indexPath).score(des)
 
-        # Calculate histogram of Features for the Query 
-        test_features = np.zeros((1, numWords), "float32")
-        words, distance = vq(query_descriptors, voc)
-        for w in words:
-            test_features[0][w] += 1 
-
-        # Perform Tf-idf vectorization for the Query
-        test_features = test_features * idf
-        test_features = preprocessing.normalize(test_features, norm='l2')
-
-        score = np.dot(test_features, im_features.T)
-        return score
+    def MapBOWMatch(self):
+        '''
+        The query's scores against the images of the current location, taken
+        from the map-wide index. The query is quantized and scored against
+        the whole map once, and every location reuses the result.
+        '''
+        index = bow.loadMapIndex(self.mapIndexPath)
+        if self.mapScores is None:
+            kp, des = self.getQueryFeatures()
+            self.mapScores = index.score(des)
+        return index.locationScores(self.mapScores, self.data)
 
 
     def SIFTMatch(self, imagePath, display_results=False):
@@ -265,9 +465,7 @@ class Matcher(object):
         Matching is done with Fast Library for Approximate Nearest Neighbors.
         Lowe's ratio test is applied.
         '''
-        sift = cv2.xfeatures2d.SIFT_create()
-
-        kp1, des1 = sift.detectAndCompute(self.image, None)
+        kp1, des1 = self.getQueryFeatures()
         kp2, des2 = self.index[imagePath]
 
         FLANN_INDEX_KDTREE = 0
@@ -290,41 +488,192 @@ class Matcher(object):
 
         return len(good)
 
+    def voteMatch(self, imagePaths):
+        '''
+        Matches the query against every image of the location at once, using
+        the single FLANN index of the location's feature index. Each query
+        descriptor searches its nearest neighbours over all images; the
+        ratio test is applied within each image among those neighbours, and
+        passing descriptors vote for their image.
+        Returns the number of matches for each of the given image paths.
+        '''
+        kp1, des1 = self.getQueryFeatures()
+        return self.voteMatchBatch([des1], imagePaths)[0]
+
+    def voteMatchBatch(self, descriptorSets, imagePaths):
+        '''
+        voteMatch for the descriptors of several query images, e.g. frames
+        from different robots, with a single FLANN search over all of them.
+        With compressed set, the search runs over the compressed descriptors
+        instead (see pq.py), scanning self.probes inverted lists and
+        re-ranking the self.rerank nearest exactly.
+        Returns a list of match counts per query.
+        '''
+        total = int(self.index.offsets[-1])
+        sizes = [0 if des is None else len(des) for des in descriptorSets]
+        if sum(sizes) == 0 or total < 2:
+            return [[0] * len(imagePaths) for des in descriptorSets]
+
+        checks = 25 if self.alg == 'SURF' else 50
+        k = min(self.voteNeighbours, total)
+        stacked = np.vstack([des for des in descriptorSets if des is not None and len(des)])
+        if self.compressed:
+            compressed = self.index.compressedIndex(self.pcaDims, self.subspaces)
+            neighbours, dists = compressed.search(stacked, k, self.rerank, self.probes)
+        else:
+            neighbours, dists = self.index.flannIndex().knnSearch(stacked, k, params=dict(checks=checks))
+        labels = self.index.labels()[neighbours]
+
+        # FLANN returns squared distances; the second-nearest neighbour of an image
+        # that appears only once is bounded by the farthest retrieved neighbour
+        second = np.repeat(dists[:, -1:], k, axis=1)
+        repeated = np.zeros(labels.shape, bool)
+        for j in range(k-1):
+            same = labels[:, j+1:] == labels[:, j:j+1]
+            found = same.any(axis=1)
+            later = j + 1 + same.argmax(axis=1)
+            second[found, j] = dists[found, later[found]]
+            repeated[:, j+1:] |= same
+        good = ~repeated & (dists < 0.49 * second)
+
+        imageIndices = [self.index.lookup[os.path.basename(imagePath)] for imagePath in imagePaths]
+        results = []
+        for start, size in zip(np.cumsum([0] + sizes[:-1]), sizes):
+            rows = slice(start, start + size)
+            votes = np.bincount(labels[rows][good[rows]], minlength=len(self.index))
+            results.append([int(votes[i]) for i in imageIndices])
+        return results
+
     def write(self, filename, mode):
         file = open(filename, mode)
-        totalMatches, results, bestMatch = self.run()
+        totalMatches, results = self.run()
         file.write(str(totalMatches) + '\n')
         file.write('[')
         for prob in results[:len(results)-1]:
             file.write(str(prob) + ', ')
         file.write(str(results[-1]) + ']\n')
 
-        angle = int(bestMatch[0].replace(self.data,'').replace('/angle','').replace('.jpg',''))
+        # The strip of the location is read once per process, later writes only redraw the rectangle
+        angle = int(np.argmax(results)) * 15
         Panorama(self.data, 100, 100, angle).write(self.data + '_panorama.jpg')
 
+    def matchImages(self, imagePaths):
+        '''
+        Number of feature matches between the query and each of the given
+        images of the current location.
+        '''
+        if self.alg == 'ORB' and isinstance(self.index, FeatureIndex):
+            return self.ORBBatchMatch(imagePaths)
+        if self.vote and self.alg != 'ORB':
+            return self.voteMatch(imagePaths)
+        matches = []
+        for imagePath in imagePaths:
+            # print('\tMatching %s ...' % imagePath)
+            if self.alg == 'SIFT':
+                matches.append(self.SIFTMatch(imagePath))
+            elif self.alg == 'SURF':
+                matches.append(self.SURFMatch(imagePath))
+            else:
+                matches.append(self.ORBMatch(imagePath))
+        return matches
+
+    def matchImagesBatch(self, descriptorSets, imagePaths):
+        '''
+        matchImages for the descriptors of several query images, e.g. frames
+        from different robots, returning a list of match counts per query.
+        The descriptors of all queries are searched together: with vote set
+        by voteMatchBatch, for ORB by one Hamming distance computation over
+        the location, and for SIFT and SURF by one FLANN search per map
+        image, with the same ratio test as SIFTMatch and SURFMatch.
+        '''
+        if self.vote and self.alg != 'ORB':
+            return self.voteMatchBatch(descriptorSets, imagePaths)
+        imageIndices = [self.index.lookup[os.path.basename(imagePath)] for imagePath in imagePaths]
+        if self.alg == 'ORB':
+            votes = self.index.hammingMatcher(self.lsh).matchBatch(descriptorSets)
+            return [[int(counts[i]) for i in imageIndices] for counts in votes]
+
+        sizes = [0 if des is None else len(des) for des in descriptorSets]
+        counts = np.zeros((len(descriptorSets), len(imagePaths)), int)
+        if sum(sizes) == 0:
+            return counts.tolist()
+        stacked = np.vstack([des for des in descriptorSets if des is not None and len(des)]).astype(np.float32)
+        owner = np.repeat(np.arange(len(descriptorSets)), sizes)
+        # The same FLANN parameters as SIFTMatch and SURFMatch
+        FLANN_INDEX_KDTREE = 0
+        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+        search_params = dict(checks=25 if self.alg == 'SURF' else 50)
+        for j, imagePath in enumerate(imagePaths):
+            kp2, des2 = self.index[imagePath]
+            if des2 is None or len(des2) < 2:
+                continue
+            flann = cv2.flann_Index(np.ascontiguousarray(des2, np.float32), index_params)
+            neighbours, dists = flann.knnSearch(stacked, 2, params=search_params)
+            # FLANN returns squared distances
+            good = dists[:, 0] < 0.49 * dists[:, 1]
+            counts[:, j] = np.bincount(owner[good], minlength=len(descriptorSets))
+        return counts.tolist()
+
+    def matchAngles(self, angleIndices):
+        '''
+        Scores only the given angle indices of the current location, returning
+        one unnormalized score per angle. Feature methods match just those
+        images, and with a cascade only its candidates among them, the others
+        getting one match; Color and BOW score the whole location, which costs
+        about the same.
+        '''
+        if self.alg == 'Color' or self.alg == 'BOW' or self.alg == 'MapBOW':
+            totalMatches, probL = self.run()
+            return [probL[i] * totalMatches for i in angleIndices]
+        imagePaths = self.anglePaths(angleIndices)
+        verify = self.cascadeFilter(imagePaths)
+        verified = dict(zip(verify, self.matchImages(verify))) if verify else {}
+        return [verified.get(imagePath, 1) for imagePath in imagePaths]
+
+    def optImages(self, bestAngleIndex, angleWindow=30):
+        '''
+        The images of the current location that optRun(bestAngleIndex,
+        angleWindow) scores. Color and BOW score all of them.
+        '''
+        imagePaths = self.anglePaths(range(25))
+        if self.alg in ('Color', 'BOW', 'MapBOW'):
+            return imagePaths
+        if bestAngleIndex is None or self.cascade is not None:
+            return self.cascadeFilter(imagePaths)
+        bestAngle = bestAngleIndex * 15
+        return [imagePath for i, imagePath in zip(range(0, 375, 15), imagePaths)
+                if min(abs(i - bestAngle) % 360, 360 - abs(i - bestAngle) % 360) <= angleWindow]
+
+    def anglePaths(self, angleIndices):
+        '''
+        Paths of the images of the current location at the given angle indices.
+        '''
+        return [self.data + '/angle' + str(i*15).zfill(3) + extension for i in angleIndices]
+
     def run(self):
         
-        if self.alg != 'Color' and self.alg != 'BOW':
-            matches = []
-            for i in range(0, 375, 15):
-                imagePath = self.data + '/angle' + str(i).zfill(3) + extension
-                # print('\tMatching %s ...' % imagePath)
-                if self.alg == 'SIFT':
-                    numMatches = self.SIFTMatch(imagePath)
-                elif self.alg == 'SURF':
-                    numMatches = self.SURFMatch(imagePath)
-                else:
-                    numMatches = self.ORBMatch(imagePath)
-                matches.append((imagePath, numMatches))
+        if self.alg != 'Color' and self.alg != 'BOW' and self.alg != 'MapBOW':
+            imagePaths = [self.data + '/angle' + str(i).zfill(3) + extension for i in range(0, 375, 15)]
+            if self.cascade is not None:
+                # Verify the candidates of the cheap stage only, as DOR does for its window
+                verify = self.cascadeFilter(imagePaths)
+                if not verify:
+                    return 1, [1/75] * 25
+                verified = dict(zip(verify, self.matchImages(verify)))
+                matches = [(imagePath, verified.get(imagePath, 1)) for imagePath in imagePaths]
+            else:
+                matches = list(zip(imagePaths, self.matchImages(imagePaths)))
 
             totalMatches = sum(list(map(lambda x: x[1], matches)))
             if totalMatches == 0:
                 totalMatches = 1
 
         elif self.alg == 'BOW':
-            for i in range(0, 375, 15):
-                score = self.BOWMatch(self.data + '.pkl')
-                return 10*np.max(score), score[0].tolist()
+            score = self.BOWMatch(self.data + ('_tree.pkl' if self.tree else '.pkl'))
+            return 10*np.max(score), score[0].tolist()
+        elif self.alg == 'MapBOW':
+            score = self.MapBOWMatch()
+            return 10*np.max(score), score.tolist()
         else:
 
             results = self.colorSearch()
@@ -337,55 +686,24 @@ class Matcher(object):
         
         return totalMatches, list(map(lambda x:x[1]/totalMatches, matches))
 
-    def optRun(self, bestAngleIndex):
-        if bestAngleIndex is not None:
-            bestAngle = bestAngleIndex * 15
-            lower = bestAngle - 30
-            upper = bestAngle + 30
-            # optimized run
-            if self.alg != 'Color' and self.alg != 'BOW':
-                matches = []
-                for i in range(0, 375, 15):
-                    imagePath = self.data + '/angle' + str(i).zfill(3) + extension
-                    if lower >= 0 and upper <= 360:
-                        if i >= lower and i <= upper:
-                            if self.alg == 'SIFT':
-                                numMatches = self.SIFTMatch(imagePath)
-                            elif self.alg == 'SURF':
-                                numMatches = self.SURFMatch(imagePath)
-                            else:
-                                numMatches = self.ORBMatch(imagePath)
-                        else:
-                            numMatches = 1
-                    else:
-                        if i >= lower % 360 or i <= upper % 360:
-                            if self.alg == 'SIFT':
-                                numMatches = self.SIFTMatch(imagePath)
-                            elif self.alg == 'SURF':
-                                numMatches = self.SURFMatch(imagePath)
-                            else:
-                                numMatches = self.ORBMatch(imagePath)
-                        else:
-                            numMatches = 1
-                    matches.append((imagePath, numMatches))
-
-                totalMatches = sum(list(map(lambda x: x[1], matches)))
-                if totalMatches == 0:
-                    totalMatches = 1
-
-            else:
+    def optRun(self, bestAngleIndex, angleWindow=30):
+        '''
+        DOR within a location: only the images within angleWindow degrees of
+        bestAngleIndex around the circle are matched, and the others get one
+        match. Color and BOW score the whole location, as in run().
+        '''
+        if bestAngleIndex is None or self.cascade is not None or self.alg in ('Color', 'BOW', 'MapBOW'):
+            return self.run()
 
-                results = self.colorSearch()
-                totalChiSquared = sum(list(map(lambda x: x[0], results)))
-                totalMatches = 300000./totalChiSquared
-                rawProbs = list(map(lambda x: (self.data + '/' + x[1], 200./x[0]), results)) # invert chi-squared
-                totalProb = sum(list(map(lambda x: x[1], rawProbs)))
-                rawMatches = list(map(lambda x: (x[0], x[1]/totalProb * totalMatches), rawProbs)) # normalize probabilities
-                matches = sorted(rawMatches, key=lambda x: int(x[0].replace(extension,'').replace(self.data+'/angle','')))
+        imagePaths = self.anglePaths(range(25))
+        window = self.optImages(bestAngleIndex, angleWindow)
+        verified = dict(zip(window, self.matchImages(window)))
+        matches = [(imagePath, verified.get(imagePath, 1)) for imagePath in imagePaths]
 
-            return totalMatches, list(map(lambda x:x[1]/totalMatches, matches))
-        else:
-            return self.run()
+        totalMatches = sum(list(map(lambda x: x[1], matches)))
+        if totalMatches == 0:
+            totalMatches = 1
+        return totalMatches, list(map(lambda x:x[1]/totalMatches, matches))
 
 if __name__ == '__main__':
 
@@ -23,167 +23,378 @@ import cv2
 import numpy as np 
 import math
 import glob
+import multiprocessing
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import belief
+import featureIndex
+import frameCache
+import mcl
+import probStore
 from Matcher import Matcher 
+from prefetch import FramePrefetcher, loadFrame
 
 extension = '.png'
 
+# State of a createRawP worker process, loaded once by initWorker
+workerAnalyzer = None
+workerMatcher = None
+
+def initWorker(method, width, height, vote, cascade=None, budget=None, grid=None, cache=None, tree=False,
+               candidates=10, candidateMargin=None, compressed=False, pcaDims=64, subspaces=16, rerank=50, probes=8):
+    global workerAnalyzer, workerMatcher
+    cv2.setNumThreads(1)
+    workerAnalyzer = analyzer(method, width, height, vote, cascade=cascade, budget=budget, grid=grid, cache=cache,
+                              tree=tree, candidates=candidates, candidateMargin=candidateMargin,
+                              compressed=compressed, pcaDims=pcaDims, subspaces=subspaces, rerank=rerank,
+                              probes=probes)
+    if method != 'BOW' and method != 'MapBOW':
+        workerAnalyzer.createIndex()
+    workerMatcher = workerAnalyzer.createMatcher()
+
+def matchWorker(imagePath):
+    return workerAnalyzer.matchFrame(workerMatcher, imagePath)
+
 class analyzer(object):
 
-    def __init__(self, method, width, height):
+    def __init__(self, method, width, height, vote=False, threads=1, prefetch=4, cascade=None, budget=None, grid=None,
+                 cache=None, tree=False, candidates=10, candidateMargin=None, compressed=False, pcaDims=64,
+                 subspaces=16, rerank=50, probes=8):
         self.numLocations = 7
+        self.numAngles = 25
         self.indices = [None] * self.numLocations
         self.method = method
         self.w = width
         self.h = height
+        self.vote = vote
+        self.compressed = compressed
+        self.pcaDims = pcaDims
+        self.subspaces = subspaces
+        self.rerank = rerank
+        self.probes = probes
+        self.cascade = cascade
+        self.candidates = candidates
+        self.candidateMargin = candidateMargin
+        self.budget = budget
+        self.grid = grid
+        self.cache = cache
+        self.tree = tree
+        self.frameCache = frameCache.FrameCache(cache) if cache is not None else None
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.prefetch = prefetch
         self.rawP = []
         self.blurP = []
-        self.commands = self.readCommand('commands.txt')
+        self.commands = self.readCommand('commands.txt') if os.path.exists('commands.txt') else {}
         self.bestGuess = []
+        self.expectedMatches = None
 
-    def createIndex(self):
+    def createIndex(self, workers=1):
         """
         Create the color or feature indices, depending on the method.
+        With more than one worker, feature extraction for all locations
+        and BOW training run in a process pool.
         """
-        matcher = Matcher(self.method, width=self.w, height=self.h)
-        if self.method != 'BOW':
+        matcher = Matcher(self.method, width=self.w, height=self.h, budget=self.budget, grid=self.grid, tree=self.tree)
+        if self.cascade == 'MapBOW' and not os.path.exists(matcher.mapIndexPath):
+            matcher.writeMapIndex()
+        if self.method == 'BOW':
+            matcher.writeIndices(workers=workers)
+        elif self.method == 'MapBOW':
+            matcher.writeMapIndex()
+        elif self.method != 'Color' and workers > 1:
+            locations = ['map/' + str(i) for i in range(self.numLocations)]
+            self.indices = featureIndex.buildIndices(locations, self.method, workers, budget=self.budget, grid=self.grid)
+        else:
             for i in range(self.numLocations):
                 matcher.setDirectory('map/' + str(i))
                 if self.method != 'Color':
                     self.indices[i] = matcher.createFeatureIndex()
                 else:
                     self.indices[i] = matcher.createColorIndex()
-        else:
-            matcher.writeIndices()
+
+    def buildVoteIndices(self):
+        """
+        Builds and saves the FLANN index, or with compressed set the compressed index, of every
+        location that vote matching reads, so that the createRawP workers all load it instead
+        of each training and writing the same file.
+        """
+        if not self.vote or self.method in ('ORB', 'Color', 'BOW', 'MapBOW'):
+            return
+        for index in self.indices:
+            if self.compressed:
+                index.compressedIndex(self.pcaDims, self.subspaces)
+            else:
+                index.flannIndex()
+
+    def createMatcher(self):
+        """
+        The Matcher for the query frames. With a cascade set to 'Color' or 'MapBOW', that
+        stage ranks all map images first and only its candidates are verified by features: the
+        best candidates images, or only those scoring within candidateMargin of the best one.
+        With a budget, at most that many keypoints are kept per image, for the map indices and
+        the query alike, optionally spread over a grid (see featureIndex.selectKeypoints).
+        With a cache directory, query features and histograms are kept in the frame cache.
+        With tree set, BOW matches against the vocabulary tree dictionaries <location>_tree.pkl.
+        With vote and compressed set, votes are searched in the compressed index of each location
+        (see pq.py) of pcaDims dimensions and subspaces codes, scanning probes inverted lists and
+        re-ranking the rerank nearest by exact distances.
+        """
+        return Matcher(self.method, width=self.w, height=self.h, vote=self.vote, cascade=self.cascade,
+                       budget=self.budget, grid=self.grid, cache=self.frameCache, tree=self.tree,
+                       candidates=self.candidates, candidateMargin=self.candidateMargin,
+                       compressed=self.compressed, pcaDims=self.pcaDims, subspaces=self.subspaces,
+                       rerank=self.rerank, probes=self.probes)
 
     ####################
     ### Main Methods ###
     ####################
 
-    def createRawP(self):
+    def createRawP(self, workers=1, chunksize=4):
         """
         This function generates a list of raw probabilities directly from image matching and
-        stores it in a file called rawP.txt
+        stores it in a file called rawP.bin, one frame at a time
+
+        With more than one worker, frames are matched in a process pool. Each worker loads
+        the map indices once, frames are handed out in chunks, and results are written in
+        frame order.
         """
-        if self.method != 'BOW':
+        if self.method != 'BOW' and self.method != 'MapBOW':
             print('Creating indices...')
-            self.createIndex()
+            self.createIndex(workers)
+            if workers > 1:
+                self.buildVoteIndices()
 
         start = time.time()
         p = []
-        matcher = Matcher(self.method, width=self.w, height=self.h)
+        imagePaths = glob.glob('cam1_img' + '/*' + extension)
+        self.writeProb(p, 'rawP.bin', 'w')
         print('Matching...')
 
-        for imagePath in glob.glob('cam1_img' + '/*' + extension):
-            matcher.setQuery(imagePath)
-            results = []
-            for i in range(self.numLocations):
-                matcher.setDirectory('map/' + str(i))
-                if self.method != 'Color':
-                    matcher.setIndex(self.indices[i])
-                else:
-                    matcher.setColorIndex(self.indices[i])
-                totalMatches, probL = matcher.run()
-                results.append([totalMatches, probL])
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=initWorker,
+                                        initargs=(self.method, self.w, self.h, self.vote, self.cascade,
+                                                  self.budget, self.grid, self.cache, self.tree, self.candidates,
+                                                  self.candidateMargin, self.compressed, self.pcaDims,
+                                                  self.subspaces, self.rerank, self.probes))
+            try:
+                for imagePath, results in zip(imagePaths, pool.imap(matchWorker, imagePaths, chunksize)):
+                    p.extend(results)
+                    self.writeProb(results, 'rawP.bin', 'a')
+                    print('\t' + imagePath)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            matcher = self.createMatcher()
+            for frame in self.frames(imagePaths, matcher):
+                results = self.matchFrame(matcher, frame.path, frame.query)
+                p.extend(results)
+                self.writeProb(results, 'rawP.bin', 'a')
+                print('\t' + frame.path)
 
-            p.extend(results)  
-            print('\t' + imagePath)
         self.rawP = p
-        self.writeProb(p, 'rawP.txt', 'w')
 
         end = time.time()
         print('Time elapsed: %0.1f' % (end-start))
 
-    def processRaw(self):
+    def matchFrame(self, matcher, imagePath, query=None):
         """
-        This function processes the raw data from rawP.txt, which is generated
-        from the createRawP function
+        Matches one frame against every location, returning [totalMatches, probL] for each.
+        The frame is read from imagePath unless its preprocessed query image is given.
+        """
+        if query is None:
+            matcher.setQuery(imagePath)
+        else:
+            matcher.setQueryImage(query)
+        return self.matchLocations(matcher, range(self.numLocations))
+
+    def frames(self, imagePaths, matcher=None):
+        """
+        Frames of the sequence with their blur factors, and their query images if a matcher is
+        given to preprocess them. Up to self.prefetch frames are loaded ahead in the background.
+        With a cache directory, both are read from the frame cache after the first run.
+        """
+        preprocess = matcher.preprocess if matcher is not None else None
+        key = matcher.preprocessKey() if matcher is not None else None
+        if self.prefetch > 0:
+            return FramePrefetcher(imagePaths, preprocess, self.prefetch, cache=self.frameCache, preprocessKey=key)
+        return (loadFrame(imagePath, preprocess, self.frameCache, key) for imagePath in imagePaths)
+
+    def matchLocations(self, matcher, locations, bestAngleIndex=None):
+        """
+        Matches the matcher's query against the given locations, returning [totalMatches, probL]
+        for each in the same order. Every location is matched by its own copy of the matcher,
+        so with threads > 1 the locations are matched concurrently in the thread pool.
         """
+        matcher.prepareQuery()
 
-        # initialize list of probabilities
-        previousProbs = []
-        for i in range(self.numLocations):
-            previousProbs.append([1, [1/75] * 25])
+        def match(i):
+            located = matcher.forLocation('map/' + str(i), self.indices[i])
+            totalMatches, probL = located.optRun(bestAngleIndex)
+            return [totalMatches, probL]
+
+        if self.executor is None:
+            return [match(i) for i in locations]
+        return list(self.executor.map(match, locations))
+
+    def processRaw(self, batch=False):
+        """
+        This function processes the raw data from rawP.bin, which is generated
+        from the createRawP function
+
+        With batch=True the whole sequence is stacked into arrays first and
+        filtered in one pass by belief.filterSequence.
+        """
 
         start = time.time()
-        probDict = self.readProb('rawP.txt')
-        blurP = []
+        rawP = self.readProb('rawP.bin')
+        frames = list(self.frames(glob.glob('cam1_img' + '/*' + extension)))
+        names = [frame.path.replace('cam1_img/', '').replace(extension, '') for frame in frames]
+
+        if batch:
+            raw = rawP[[int(name) for name in names]]
+            out, bestGuess = belief.filterSequence(raw, [self.commands[name] for name in names],
+                                                   [frame.blur for frame in frames])
+            self.bestGuess = bestGuess.tolist()
+            self.blurP = probStore.circleList(out.reshape(-1, out.shape[2]))
+            self.writeProb(self.blurP, 'out.bin', 'w')
+            self.writeBestGuess(self.bestGuess, 'bestGuess.bin', 'w')
 
-        for imagePath in glob.glob('cam1_img' + '/*' + extension):
-            # Read probability list from the raw output file
-            p = probDict[imagePath.replace('cam1_img/', '').replace(extension, '')]
+        else:
+            # initialize the belief
+            previousProbs = belief.Belief.uniform(self.numLocations, self.numAngles)
+            blurP = []
+            self.writeProb(blurP, 'out.bin', 'w')
+            self.writeBestGuess(self.bestGuess, 'bestGuess.bin', 'w')
 
-            # Read and account for the command
-            command = self.commands[imagePath.replace('cam1_img/', '').replace(extension, '')]
-            actionAccount = self.accountCommand(command, previousProbs)
+            for frame, name in zip(frames, names):
 
-            # Weight and account 
-            adjusted = self.prevWeight(actionAccount, p)
+                # Read probability list from the raw output file
+                p = belief.Belief.fromArray(rawP[int(name)])
 
-            # Calculate and adjust for blur          
-            blurFactor = self.Laplacian(imagePath)
-            adjusted = self.probUpdate(actionAccount, adjusted, blurFactor)
+                # Read and account for the command
+                actionAccount = self.accountCommand(self.commands[name], previousProbs)
 
-            bestCircles = []
-            for i in range(self.numLocations):
-                bestCircles.append(adjusted[i])
+                # Weight and account 
+                adjusted = self.prevWeight(actionAccount, p)
 
-            # Calculate angle and position
-            bestCircleIndex = adjusted.index(max(bestCircles))
-            bestAngleIndex = adjusted[bestCircleIndex][1].index(max(adjusted[bestCircleIndex][1]))
-            self.bestGuess.extend([[bestCircleIndex, bestAngleIndex]])
+                # Calculate and adjust for blur          
+                adjusted = self.probUpdate(actionAccount, adjusted, frame.blur)
 
-            blurP.extend(adjusted)
-            previousProbs = adjusted
-            print(imagePath)
+                # Calculate angle and position
+                self.bestGuess.append(list(adjusted.best()))
 
-        self.blurP = blurP
-        self.writeProb(self.blurP, 'out.txt', 'w')
-        self.writeProb(self.bestGuess, 'bestGuess.txt', 'w')
+                blurP.extend(adjusted.toList())
+                self.writeProb(adjusted.toList(), 'out.bin', 'a')
+                self.writeBestGuess(self.bestGuess[-1:], 'bestGuess.bin', 'a')
+                previousProbs = adjusted
+                print(frame.path)
+
+            self.blurP = blurP
 
         end = time.time()
         print('Time elapsed: %0.1f' % (end-start))
 
-    def optP(self):
+    def dorMatch(self, matcher, prior, blurFactor, massThreshold=0.9, minAngleWindow=15, surprise=0.5):
+        """
+        Adaptive DOR for one frame. The windows are sized from the prior belief: a location window
+        from the margin between the two best locations, and an angle window per location from the
+        entropy of its angle probabilities, both widened when the previous frame was blurred
+        (blurFactor). The whole location window is matched first, then the other locations in
+        order of prior probability until the matched locations hold massThreshold of the
+        posterior. If the best match falls below surprise times the recent best matches, the
+        robot may have been kidnapped and every location is matched.
+        Returns [totalMatches, probL] per location and the number of images matched.
+        """
+        sharpness = belief.blurWeight(blurFactor, cap=1)
+        totals = prior.header[:, belief.TOTAL]
+        order = [int(i) for i in np.argsort(-totals, kind='stable')]
+        margin = (totals[order[0]] - totals[order[1]]) / totals[order[0]] if len(order) > 1 else 1
+        locationWindow = int(round((1 - margin * sharpness) * (self.numLocations - 1)))
+        angleSpread = 1 - (1 - belief.spread(prior.probs)) * sharpness
+        angleWindows = 15 * np.ceil((minAngleWindow + angleSpread * (180 - minAngleWindow)) / 15)
+        angleIndices = prior.probs.argmax(axis=1)
+
+        bestCircleIndex = prior.best()[0]
+        inWindow = [i for i in order if abs(i - bestCircleIndex) <= locationWindow]
+        outside = [i for i in order if abs(i - bestCircleIndex) > locationWindow]
+        results = [[1, [1/75] * 25] for i in range(self.numLocations)]
+        matched = []
+        numImages = 0
+        matcher.prepareQuery()
+        for i in inWindow + outside:
+            if i in outside and self.matchedMass(prior, results, matched, blurFactor) >= massThreshold:
+                break
+            located = matcher.forLocation('map/' + str(i), self.indices[i])
+            results[i] = list(located.optRun(int(angleIndices[i]), angleWindows[i]))
+            matched.append(i)
+            numImages += len(located.optImages(int(angleIndices[i]), angleWindows[i]))
+
+        bestMatches = max(results[i][0] for i in matched)
+        if self.expectedMatches is not None and bestMatches < surprise * self.expectedMatches:
+            for i in order:
+                if i not in matched:
+                    located = matcher.forLocation('map/' + str(i), self.indices[i])
+                    results[i] = list(located.run())
+                    numImages += len(located.optImages(None))
+        self.expectedMatches = bestMatches if self.expectedMatches is None else 0.7 * self.expectedMatches + 0.3 * bestMatches
+        return results, numImages
+
+    def matchedMass(self, prior, results, matched, blurFactor):
+        """
+        Share of the posterior total matches held by the matched locations.
+        """
+        adjusted = self.probUpdate(prior, self.prevWeight(prior, belief.Belief.fromList(results)), blurFactor)
+        totals = adjusted.header[:, belief.TOTAL]
+        return totals[matched].sum() / totals.sum()
+
+    def optP(self, adaptive=False, **params):
         """
         Dynamically Optimized Retrieval (DOR), which works by only considering the nearest particles
         to the current position and angle, and assigning small non-zero probabilities to the other
         particles
+
+        With adaptive=True the windows follow the confidence of the belief, see dorMatch, whose
+        parameters can be passed as keywords.
         """
 
-        if self.method != 'BOW':
+        if self.method != 'BOW' and self.method != 'MapBOW':
             print('Creating indices...')
             self.createIndex()
 
         blurP = []
-        previousProbs = []
         bestAngleIndex = None
         bestCircleIndex = None
+        previousBlur = 0
+        self.expectedMatches = None
 
-        # initialize probability list
-        for i in range(self.numLocations):
-            previousProbs.append([1, [1/75] * 25])
+        # initialize the belief
+        previousProbs = belief.Belief.uniform(self.numLocations, self.numAngles)
 
-        matcher = Matcher(self.method, width=self.w, height=self.h)
+        matcher = self.createMatcher()
         start = time.time()
+        self.writeProb(blurP, 'out.bin', 'w')
+        self.writeBestGuess(self.bestGuess, 'bestGuess.bin', 'w')
         print('Matching...')
 
-        for imagePath in glob.glob('cam1_img' + '/*' + extension):
-            p = []
-            matcher.setQuery(imagePath)
+        for frame in self.frames(glob.glob('cam1_img' + '/*' + extension), matcher):
+            imagePath = frame.path
+            matcher.setQueryImage(frame.query)
+
+            # Read and account for command
+            command = self.commands[imagePath.replace('cam1_img/', '').replace(extension, '')]
+            actionAccount = self.accountCommand(command, previousProbs)
+
             results = []
-            if bestCircleIndex == None:
-                for i in range(self.numLocations):
-                    matcher.setDirectory('map/' + str(i))
-                    if self.method != 'Color':
-                        matcher.setIndex(self.indices[i])
-                    else:
-                        matcher.setColorIndex(self.indices[i])
+            if adaptive:
+                results, numImages = self.dorMatch(matcher, actionAccount, previousBlur, **params)
+                print('\t%s (%d images)' % (imagePath, numImages))
 
-                    # Call the optimized image matching algorithm in Matcher
-                    totalMatches, probL = matcher.optRun(bestAngleIndex)
-                    results.append([totalMatches, probL])
+            elif bestCircleIndex == None:
+                # Call the optimized image matching algorithm in Matcher
+                results = self.matchLocations(matcher, range(self.numLocations), bestAngleIndex)
 
             else:
 
@@ -191,46 +402,97 @@ class analyzer(object):
                 lower = bestCircleIndex - 2
                 upper = bestCircleIndex + 2
 
+                nearby = [i for i in range(self.numLocations) if i >= lower and i <= upper]
+                matched = dict(zip(nearby, self.matchLocations(matcher, nearby, bestAngleIndex)))
                 for i in range(self.numLocations):
-                    if i >= lower and i <= upper:
-                        matcher.setDirectory('map/' + str(i))
-                        if self.method != 'Color':
-                            matcher.setIndex(self.indices[i])
-                        else:
-                            matcher.setColorIndex(self.indices[i])
-                        totalMatches, probL = matcher.optRun(bestAngleIndex)
-                        results.append([totalMatches, probL])
+                    if i in matched:
+                        results.append(matched[i])
                     else:
                         results.append([1, [1/75] * 25])
 
-
-            p.extend(results)  
-            print('\t' + imagePath)
-
-            # Read and account for command
-            command = self.commands[imagePath.replace('cam1_img/', '').replace(extension, '')]
-            actionAccount = self.accountCommand(command, previousProbs)
+            p = belief.Belief.fromList(results)
+            if not adaptive:
+                print('\t' + imagePath)
 
             # Weight the previous generation of probabilities
             adjusted = self.prevWeight(actionAccount, p)
 
             # Adjusting for Blur
-            blurFactor = self.Laplacian(imagePath)
-            adjusted = self.probUpdate(actionAccount, adjusted, blurFactor)
+            adjusted = self.probUpdate(actionAccount, adjusted, frame.blur)
 
             # Calculate position and angle
-            bestCircleIndex = adjusted.index(max(adjusted))
-            bestAngleIndex = adjusted[bestCircleIndex][1].index(max(adjusted[bestCircleIndex][1]))
-            self.bestGuess.extend([[bestCircleIndex, bestAngleIndex]])
-            blurP.extend(adjusted)
+            bestCircleIndex, bestAngleIndex = adjusted.best()
+            self.bestGuess.append([bestCircleIndex, bestAngleIndex])
+            blurP.extend(adjusted.toList())
+            self.writeProb(adjusted.toList(), 'out.bin', 'a')
+            self.writeBestGuess(self.bestGuess[-1:], 'bestGuess.bin', 'a')
             previousProbs = adjusted
+            previousBlur = frame.blur
 
         self.blurP = blurP
-        self.writeProb(self.blurP, 'out.txt', 'w')
-        self.writeProb(self.bestGuess, 'bestGuess.txt', 'w')
         end = time.time()
         print('Time elapsed: %0.1f' % (end-start))
 
+    def mclP(self, **params):
+        """
+        Particle Monte Carlo Localization. Only the map images occupied by particles are matched
+        against each frame, so the matching work shrinks as the particle set concentrates. Keyword
+        arguments are passed to mcl.ParticleFilter. Writes out.bin and bestGuess.bin like processRaw.
+        With a cascade, only the occupied images among its candidates are verified.
+        """
+
+        if self.method != 'BOW' and self.method != 'MapBOW':
+            print('Creating indices...')
+            self.createIndex()
+
+        blurP = []
+        particleFilter = mcl.ParticleFilter(self.numLocations, **params)
+        matcher = self.createMatcher()
+        start = time.time()
+        totalImages = 0
+        self.writeProb(blurP, 'out.bin', 'w')
+        self.writeBestGuess(self.bestGuess, 'bestGuess.bin', 'w')
+        print('Matching...')
+
+        for frame in self.frames(glob.glob('cam1_img' + '/*' + extension), matcher):
+            imagePath = frame.path
+            matcher.setQueryImage(frame.query)
+            matcher.prepareQuery()
+
+            # Move the particles according to the command
+            command = self.commands[imagePath.replace('cam1_img/', '').replace(extension, '')]
+            particleFilter.predict(command)
+
+            # Match the occupied map images only
+            occupied = particleFilter.occupied()
+
+            def match(i):
+                located = matcher.forLocation('map/' + str(i), self.indices[i])
+                verified = len(located.cascadeFilter(located.anglePaths(occupied[i])))
+                return dict(zip(occupied[i], located.matchAngles(occupied[i]))), verified
+
+            if self.executor is None:
+                results = dict((i, match(i)) for i in occupied)
+            else:
+                results = dict(zip(occupied, self.executor.map(match, occupied)))
+            scores = dict((i, result[0]) for i, result in results.items())
+            numImages = sum(result[1] for result in results.values())
+            totalImages += numImages
+
+            # Weight by the matches and the blur factor, then resample
+            particleFilter.update(scores, frame.blur)
+            self.bestGuess.append(list(particleFilter.best()))
+            blurP.extend(particleFilter.toList())
+            self.writeProb(particleFilter.toList(), 'out.bin', 'a')
+            self.writeBestGuess(self.bestGuess[-1:], 'bestGuess.bin', 'a')
+            print('\t%s: %d particles, %d images matched' % (imagePath, len(particleFilter), numImages))
+            particleFilter.resample()
+
+        self.blurP = blurP
+        end = time.time()
+        print('Images matched: %d' % totalImages)
+        print('Time elapsed: %0.1f' % (end-start))
+
 
     ############################
     ### Probability Updating ###
@@ -241,99 +503,20 @@ class analyzer(object):
         Weigh the current generation proportional to the blur factor, which
         is calculated using the variance of the Laplacian operator.
         """
-        currentWeight = 0
-        if blurFactor > 200:
-            currentWeight = 0.85
-        else:
-            currentWeight = (blurFactor / 200) * 0.85
-        previousWeight = 1 - currentWeight
-
-        # Assigning the weight to each list
-        truePosition = []
-        for i in range(self.numLocations):
-            truePosition.append([0, []])
-
-        for circleIndex in range(len(truePosition)):
-            currentCircle = currentP[circleIndex]
-            previousCircle = previousP[circleIndex]
-
-            # Number of matches 
-            current_num_matches = currentCircle[0]
-            previous_num_matches = previousCircle[0]
-            
-            # Each probability list
-            current_probList = currentCircle[1]
-            previous_probList = previousCircle[1]
-
-            truePosition[circleIndex][0] = (currentWeight * current_num_matches + previousWeight * previous_num_matches)
-            for probIndex in range(len(currentP[circleIndex][1])): 
-
-                current_prob = current_probList[probIndex]
-                previous_prob = previous_probList[probIndex]
-
-                truePosition[circleIndex][1].append(currentWeight * current_prob + previousWeight * previous_prob)
-
-        return truePosition
+        return belief.probUpdate(previousP, currentP, blurFactor)
 
     def prevWeight(self, previousP, currentP):
         """
         Weight the previous generation by a pre-determined amount
         """
-        currentWeight = 0.7
-        previousWeight = 1- currentWeight
-
-        # Assigning the weight to each list
-        truePosition = []
-        for i in range(self.numLocations):
-            truePosition.append([0, []])
-
-        for circleIndex in range(len(truePosition)):
-            currentCircle = currentP[circleIndex]
-            previousCircle = previousP[circleIndex]
-
-            # Number of matches 
-            current_num_matches = currentCircle[0]
-            previous_num_matches = previousCircle[0]
-            
-            # Each probability list
-            current_probList = currentCircle[1]
-            previous_probList = previousCircle[1]
-
-            truePosition[circleIndex][0] = (currentWeight * current_num_matches + previousWeight * previous_num_matches)
-            for probIndex in range(len(currentP[circleIndex][1])): 
-
-                current_prob = current_probList[probIndex]
-                previous_prob = previous_probList[probIndex]
-
-                truePosition[circleIndex][1].append(currentWeight * current_prob + previousWeight * previous_prob)
-
-        return truePosition
+        return belief.prevWeight(previousP, currentP)
 
     def accountCommand(self, command, previousP):
         """
-        Shift particles according to the current command
+        Shift particles according to the current command. The previous
+        belief is left untouched.
         """
-        # Left -- rotate all particles counterclockwise by 15 degrees
-        copy = previousP[:]
-        if command == 'l':
-            for circles in copy:
-                circles[1] = circles[1][1:] + circles[1][0:1]
-
-        # Right -- rotate all particles clockwise by 15 degrees
-        elif command == 'r':
-            for circles in copy:
-                circles[1] = circles[1][-1:] + circles[1][0:-1]
-
-        # Forward -- add more weight to the next location
-        elif command == 'f':
-            bestCircleIndex = previousP.index(max(previousP))
-            bestAngleIndex = previousP[bestCircleIndex][1].index(max(previousP[bestCircleIndex][1]))
-            factor = 0.05 * abs(math.sin(bestAngleIndex*15 * 180/math.pi))
-            if bestCircleIndex < self.numLocations - 1 and bestAngleIndex*15 < 180 and bestAngleIndex > 0:
-                copy[bestCircleIndex+1][0] *= (1 + factor)
-            elif bestCircleIndex > 0 and bestAngleIndex*15 > 180 and bestAngleIndex*15 < 360: 
-                copy[bestCircleIndex-1][0] *= (1 + factor)
-        return copy
+        return belief.accountCommand(previousP, command)
 
 
     ###################################
@@ -349,11 +532,14 @@ class analyzer(object):
 
 
     def writeProb(self, prob, filename, mode):
-        ''' this function write out the probabilistic values to a txt file'''
-        file = open(filename, mode)
-        for index in prob:
-            file.write(str(index[0]) + '\n')
-            file.write(str(index[1]) + '\n')
+        ''' this function writes out the probabilistic values of whole frames to a binary file,
+        see probStore. Mode 'w' starts a new file and 'a' appends'''
+        frames = probStore.circleArray(prob).reshape(-1, self.numLocations, 1 + self.numAngles)
+        probStore.writeFrames(filename, frames, mode)
+
+    def writeBestGuess(self, bestGuess, filename, mode):
+        ''' this function writes out the best guesses to a binary file'''
+        probStore.writeFrames(filename, np.array(bestGuess, np.int32).reshape(-1, 2), mode, np.int32)
 
     def readCommand(self, filename):
         '''this function reads the command list from the robot'''
@@ -366,11 +552,7 @@ class analyzer(object):
 
     def readBestGuess(self, filename):
         '''this function reads the list of best guesses of the robot's position at every position'''
-        file = open(filename, 'r')
-        content = file.read().split('\n')[:-1]
-        content = list(map(int, content))
-        bestGuesses = [[content[x], content[x+1]] for x in range(len(content) - 1 ) [::2]    ]
-        return bestGuesses
+        return probStore.readFrames(filename).tolist()
 
     def readCoord(self, filename):
         file = open(filename, 'r')
@@ -379,23 +561,9 @@ class analyzer(object):
         return coordinates
 
     def readProb(self, filename):
-        '''this function reads the content of a txt file, turn the data into  dictionaries of 
-        circles'''
-        file = open(filename, 'r')
-        raw_content = file.read().split('\n')[:-1]
-        raw_chunks = [raw_content[i:i+2] for i in range(0, len(raw_content), 2)]
-        raw_probL = [raw_chunks[i:i+self.numLocations] for i in range(0, len(raw_chunks), self.numLocations)]
-        probD = {}
-        counter = 0
-        for prob in raw_probL:
-            content = []
-            for location in prob:
-                totalMatches = float(location[0])
-                probabilities = list(map(float, location[1].replace('[','').replace(']','').split(',')))
-                content.append([totalMatches, probabilities])
-            probD[str(counter).zfill(4)] = content
-            counter += 1
-        return probD    
+        '''this function reads a binary probability file as a memory-mapped
+        (frames, locations, 1 + angles) array'''
+        return probStore.readFrames(filename)
 
 
     #############################
@@ -440,6 +608,4 @@ class analyzer(object):
 
     def Laplacian(self, imagePath):
         ''' this function calcualte the blurriness factor using variance of the Laplacian'''
-        img = cv2.imread(imagePath, 0)
-        var = cv2.Laplacian(img, cv2.CV_64F).var()
-        return var     
+        return loadFrame(imagePath, cache=self.frameCache).blur     
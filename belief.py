@@ -0,0 +1,194 @@
+'''
+Filter Belief
+=============
+
+Array representation of the localization belief used by analyzer.
+For every location the belief keeps a header row of
+(total matches, current weight) and a row of angle probabilities:
+
+    header    (locations, 2)        float64
+    probs     (locations, angles)   float64
+
+The current weight is the weight given to the latest observation
+by the blur-dependent update.
+
+The motion model and both weighting steps are array operations,
+and filterSequence runs the whole filter over a stored sequence of
+raw matching results.
+'''
+
+import math
+import numpy as np
+
+TOTAL = 0
+WEIGHT = 1
+
+
+class Belief(object):
+
+    def __init__(self, header, probs):
+        self.header = np.asarray(header, np.float64)
+        self.probs = np.asarray(probs, np.float64)
+
+    @classmethod
+    def uniform(cls, numLocations, numAngles=25):
+        header = np.zeros((numLocations, 2))
+        header[:, TOTAL] = 1
+        return cls(header, np.full((numLocations, numAngles), 1/75))
+
+    @classmethod
+    def fromList(cls, circles):
+        '''
+        Converts the list format [[totalMatches, probL], ...] of rawP.txt.
+        '''
+        header = np.zeros((len(circles), 2))
+        header[:, TOTAL] = [circle[0] for circle in circles]
+        return cls(header, [circle[1] for circle in circles])
+
+    @classmethod
+    def fromArray(cls, frame):
+        '''
+        Converts a (locations, 1 + angles) frame of probStore.
+        '''
+        frame = np.asarray(frame, np.float64)
+        header = np.zeros((len(frame), 2))
+        header[:, TOTAL] = frame[:, 0]
+        return cls(header, frame[:, 1:])
+
+    def toArray(self):
+        return np.column_stack((self.header[:, TOTAL], self.probs))
+
+    def toList(self):
+        return [[total, probs] for total, probs in zip(self.header[:, TOTAL].tolist(), self.probs.tolist())]
+
+    def copy(self):
+        return Belief(self.header.copy(), self.probs.copy())
+
+    def best(self):
+        '''
+        Returns (location, angle) of the best guess. Locations are compared by
+        total matches, then by their probability lists, and the first of
+        equal locations wins, as with max() over the list format.
+        '''
+        bestCircleIndex, bestAngleIndex = bestGuesses(np.column_stack((self.header[:, TOTAL], self.probs))[None])[0]
+        return int(bestCircleIndex), int(bestAngleIndex)
+
+
+def bestGuesses(states):
+    '''
+    Best (location, angle) of each belief in a (frames, locations, 1 + angles)
+    array, with the tie-breaking of Belief.best.
+    '''
+    states = np.asarray(states)
+    candidates = np.ones(states.shape[:2], bool)
+    for column in range(states.shape[2]):
+        values = np.where(candidates, states[:, :, column], -np.inf)
+        candidates &= values == values.max(axis=1, keepdims=True)
+        if candidates.sum() == len(states):
+            break
+    bestCircleIndex = candidates.argmax(axis=1)
+    probs = states[np.arange(len(states)), bestCircleIndex, 1:]
+    return np.column_stack((bestCircleIndex, probs.argmax(axis=1)))
+
+def spread(weights):
+    '''
+    Normalized entropy over the last axis: 0 when all the weight is in one
+    entry, 1 when it is spread evenly.
+    '''
+    weights = np.maximum(np.asarray(weights, np.float64), 0)
+    p = weights / np.maximum(weights.sum(axis=-1, keepdims=True), 1e-300)
+    entropy = -np.sum(np.where(p > 0, p * np.log(np.where(p > 0, p, 1)), 0), axis=-1)
+    return entropy / math.log(weights.shape[-1])
+
+
+def accountCommand(previous, command, forwardFactor=0.05):
+    '''
+    Shifts the belief according to the command, returning a new Belief.
+    '''
+    shifted = previous.copy()
+
+    # Left -- rotate all particles counterclockwise by 15 degrees
+    if command == 'l':
+        shifted.probs = np.roll(shifted.probs, -1, axis=1)
+
+    # Right -- rotate all particles clockwise by 15 degrees
+    elif command == 'r':
+        shifted.probs = np.roll(shifted.probs, 1, axis=1)
+
+    # Forward -- add more weight to the next location
+    elif command == 'f':
+        bestCircleIndex, bestAngleIndex = previous.best()
+        factor = forwardFactor * abs(math.sin(bestAngleIndex*15 * 180/math.pi))
+        if bestCircleIndex < len(shifted.header) - 1 and bestAngleIndex*15 < 180 and bestAngleIndex > 0:
+            shifted.header[bestCircleIndex+1, TOTAL] *= (1 + factor)
+        elif bestCircleIndex > 0 and bestAngleIndex*15 > 180 and bestAngleIndex*15 < 360:
+            shifted.header[bestCircleIndex-1, TOTAL] *= (1 + factor)
+    return shifted
+
+def prevWeight(previous, current, currentWeight=0.7):
+    '''
+    Weight the previous generation by a pre-determined amount.
+    '''
+    header = np.zeros_like(current.header)
+    header[:, TOTAL] = currentWeight * current.header[:, TOTAL] + (1 - currentWeight) * previous.header[:, TOTAL]
+    header[:, WEIGHT] = currentWeight
+    return Belief(header, currentWeight * current.probs + (1 - currentWeight) * previous.probs)
+
+def blurWeight(blurFactor, threshold=200, cap=0.85):
+    '''
+    Weight of the current observation given the variance of the Laplacian.
+    '''
+    if blurFactor > threshold:
+        return cap
+    return (blurFactor / threshold) * cap
+
+def probUpdate(previous, current, blurFactor, threshold=200, cap=0.85):
+    '''
+    Weigh the current generation proportional to the blur factor.
+    '''
+    return prevWeight(previous, current, blurWeight(blurFactor, threshold, cap))
+
+def filterSequence(raw, commands, blurFactors, initial=None, currentWeight=0.7, threshold=200, cap=0.85,
+                   forwardFactor=0.05):
+    '''
+    Runs the filter over a whole sequence. raw is a (frames, locations,
+    1 + angles) array of total matches followed by angle probabilities,
+    commands and blurFactors have one entry per frame. Returns the filtered
+    array of the same shape and the (frames, 2) best guesses. The remaining
+    arguments are the constants of prevWeight, probUpdate and accountCommand.
+
+    The result is the same as stepping a Belief through accountCommand,
+    prevWeight and probUpdate frame by frame, but the states are written
+    straight into the output array and the best guesses are found for all
+    frames at once.
+    '''
+    raw = np.asarray(raw, np.float64)
+    out = np.empty_like(raw)
+    if initial is None:
+        initial = Belief.uniform(raw.shape[1], raw.shape[2] - 1)
+    previous = np.column_stack((initial.header[:, TOTAL], initial.probs))
+
+    blurFactors = np.asarray(blurFactors, np.float64)
+    weights = [blurWeight(blurFactor, threshold, cap) for blurFactor in blurFactors.tolist()]
+    shifted = np.empty_like(previous)
+    adjusted = np.empty_like(previous)
+
+    for t in range(len(raw)):
+        command = commands[t]
+        shifted[:] = previous
+        if command == 'l':
+            shifted[:, 1:] = np.roll(previous[:, 1:], -1, axis=1)
+        elif command == 'r':
+            shifted[:, 1:] = np.roll(previous[:, 1:], 1, axis=1)
+        elif command == 'f':
+            state = Belief(np.column_stack((previous[:, TOTAL], np.zeros(len(previous)))), previous[:, 1:])
+            shifted[:, TOTAL] = accountCommand(state, command, forwardFactor).header[:, TOTAL]
+
+        # prevWeight, then probUpdate
+        np.multiply(raw[t], currentWeight, out=adjusted)
+        adjusted += (1 - currentWeight) * shifted
+        np.multiply(adjusted, weights[t], out=out[t])
+        out[t] += (1 - weights[t]) * shifted
+        previous = out[t]
+
+    return out, bestGuesses(out)
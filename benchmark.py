@@ -0,0 +1,103 @@
+'''
+Keypoint Budget Benchmark
+=========================
+
+Measures the accuracy/latency trade-off of the keypoint budget.
+For every budget the map indices are built with that budget, the
+frames of cam1_img are matched against every location, and the
+raw results are filtered by belief.filterSequence and scored with
+the metrics of error.py. Matching time per frame includes the
+extraction of the query features.
+
+The first configuration, normally the one without a budget, is
+the reference: agreement is the fraction of frames whose best
+guess is the same as with the reference.
+
+Usage:
+------
+    python benchmark.py -a [<algorithm>] -b none,1000,500,250,100 -g [<grid>]
+
+    Prints one row per budget.
+'''
+
+import glob
+import os
+import time
+import numpy as np
+
+import belief
+import error
+import probStore
+from analyze import analyzer
+
+extension = '.png'
+
+
+def benchmarkBudget(method, width, height, budget=None, grid=None, vote=False, source='cam1_img'):
+    '''
+    Matches the frames of source with one keypoint budget. Returns the
+    mean number of keypoints per map image, the matching times per frame,
+    the (frames, 2) best guesses and the (frames, angles) probabilities
+    of the best guessed locations, with frames in name order.
+    '''
+    loader = analyzer(method, width, height, vote, prefetch=0, budget=budget, grid=grid)
+    loader.createIndex()
+    matcher = loader.createMatcher()
+    keypoints = np.mean(np.concatenate([np.diff(index.offsets) for index in loader.indices]))
+
+    frames = list(loader.frames(sorted(glob.glob(source + '/*' + extension)), matcher))
+    times = []
+    raw = []
+    for frame in frames:
+        start = time.time()
+        results = loader.matchFrame(matcher, frame.path, frame.query)
+        times.append(time.time() - start)
+        raw.append(probStore.circleArray(results))
+
+    names = [os.path.basename(frame.path).replace(extension, '') for frame in frames]
+    commands = [loader.commands.get(name, 's') for name in names]
+    out, bestGuess = belief.filterSequence(np.array(raw), commands, [frame.blur for frame in frames])
+    return keypoints, np.array(times), bestGuess, out[np.arange(len(out)), bestGuess[:, 0], 1:]
+
+def benchmarkBudgets(method, width, height, budgets, grid=None, vote=False, coordPath='coord.txt'):
+    '''
+    Runs benchmarkBudget for every budget, None standing for no budget.
+    Returns a list of dictionaries, one per budget, in the given order.
+    '''
+    coordinates = error.readCoord(coordPath) if os.path.exists(coordPath) else None
+    rows = []
+    reference = None
+    for budget in budgets:
+        keypoints, times, bestGuess, bestProbs = benchmarkBudget(method, width, height, budget,
+                                                                 grid if budget else None, vote)
+        if reference is None:
+            reference = bestGuess
+        row = {'budget': budget, 'keypoints': keypoints, 'latency': np.mean(times),
+               'p99': np.percentile(times, 99), 'agreement': np.mean(np.all(bestGuess == reference, axis=1))}
+        if coordinates is not None:
+            row['success'] = float(error.successScores(bestGuess, coordinates))
+            row['error'] = float(error.errorScores(bestProbs, coordinates))
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-a', '--algorithm', default='SIFT', help='Feature algorithm: SIFT, SURF, or ORB')
+    ap.add_argument('-b', '--budgets', default='none,1000,500,250,100', help='Keypoint budgets, none for no budget')
+    ap.add_argument('-g', '--grid', type=int, default=None, help='Cells per side of the budget grid')
+    ap.add_argument('-v', '--vote', action='store_true', help='Match with one FLANN index per location')
+    ap.add_argument('--width', type=int, default=320)
+    ap.add_argument('--height', type=int, default=240)
+    args = vars(ap.parse_args())
+
+    budgets = [None if budget == 'none' else int(budget) for budget in args['budgets'].split(',')]
+    rows = benchmarkBudgets(args['algorithm'], args['width'], args['height'], budgets, args['grid'], args['vote'])
+
+    print('%8s %10s %10s %10s %10s %8s %10s' % ('budget', 'keypoints', 'ms/frame', 'p99 ms', 'agreement', 'success', 'error'))
+    for row in rows:
+        print('%8s %10.0f %10.1f %10.1f %10.2f %8.2f %10.1f' % (row['budget'] or 'none', row['keypoints'],
+              row['latency'] * 1000, row['p99'] * 1000, row['agreement'], row.get('success', float('nan')),
+              row.get('error', float('nan'))))
@@ -0,0 +1,404 @@
+'''
+Bag-of-Words Indices
+====================
+
+Keeps the Bag-of-Words dictionaries of the map in memory, so that
+each `.pkl` written by Matcher.writeIndices is read only once per
+process, and scores query descriptors against them.
+
+Dictionaries are loaded memory-mapped when they were written
+without compression.
+
+MapBOW indexes the whole map with a single vocabulary and an
+inverted file, so that one quantization of the query ranks every
+image of every location.
+
+VocabularyTree is a hierarchical vocabulary that can replace the
+flat k-means vocabulary of a location, for faster training and
+quantization.
+'''
+
+import cv2
+import numpy as np
+import glob
+import os
+import tempfile
+
+from sklearn.externals import joblib
+from scipy import sparse
+from scipy.cluster.vq import kmeans, vq
+from sklearn import preprocessing
+from sklearn.cluster import MiniBatchKMeans
+
+loadedIndices = {}
+
+
+def loadIndex(indexPath):
+    '''
+    Returns the BOWIndex of a dictionary file, loading it on first use.
+    The index is reloaded if the file was rewritten since.
+    '''
+    mtime = os.path.getmtime(indexPath)
+    index = loadedIndices.get(indexPath)
+    if index is None or index.mtime != mtime:
+        index = BOWIndex(indexPath)
+        loadedIndices[indexPath] = index
+    return index
+
+
+class BOWIndex(object):
+
+    def __init__(self, indexPath):
+        self.path = indexPath
+        self.mtime = os.path.getmtime(indexPath)
+        self.im_features, self.image_paths, self.idf, self.numWords, self.voc = joblib.load(indexPath, mmap_mode='r')
+
+    def histogram(self, descriptors):
+        '''
+        Term frequencies of the visual words in a set of descriptors.
+        '''
+        words = quantize(self.voc, descriptors)
+        return np.bincount(words, minlength=len(self.idf)).astype('float32')
+
+    def score(self, descriptors):
+        '''
+        Cosine similarity between the tf-idf vector of the descriptors and
+        every image in the dictionary, as a (1, images) array.
+        '''
+        if descriptors is None or len(descriptors) == 0:
+            return np.zeros((1, len(self.im_features)), 'float32')
+        features = self.histogram(descriptors)[None, :] * self.idf
+        features = preprocessing.normalize(features, norm='l2')
+        return np.dot(features, self.im_features.T)
+
+
+################
+### Training ###
+################
+
+class DescriptorStore(object):
+    '''
+    Descriptors of many images, appended image by image to a float32 file
+    and read back memory-mapped, so that training never holds the whole
+    descriptor set in memory.
+    '''
+
+    def __init__(self, directory='.', dim=128):
+        handle, self.path = tempfile.mkstemp(suffix='.f32', dir=directory)
+        self.file = os.fdopen(handle, 'wb')
+        self.dim = dim
+        self.offsets = [0]
+        self.data = None
+
+    def append(self, descriptors):
+        if descriptors is not None and len(descriptors):
+            np.ascontiguousarray(descriptors, 'float32').tofile(self.file)
+            self.offsets.append(self.offsets[-1] + len(descriptors))
+        else:
+            self.offsets.append(self.offsets[-1])
+
+    def finish(self):
+        self.file.close()
+        if self.offsets[-1]:
+            self.data = np.memmap(self.path, 'float32', 'r', shape=(self.offsets[-1], self.dim))
+        else:
+            self.data = np.zeros((0, self.dim), 'float32')
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def chunks(self, size):
+        '''
+        Consecutive blocks of at least size descriptors (all of them if there
+        are fewer), read from the memory-mapped file one block at a time.
+        '''
+        total = len(self.data)
+        starts = list(range(0, max(total - size, 0) + 1, size)) if total > size else [0]
+        for start, end in zip(starts, starts[1:] + [total]):
+            yield self.data[start:end]
+
+    def sample(self, perImage=None, limit=200000, seed=0):
+        '''
+        Copies at most perImage randomly chosen descriptors of every image,
+        and at most limit descriptors in all, into one array for clustering.
+        Only the chosen rows are read from the memory-mapped file.
+        '''
+        rng = np.random.RandomState(seed)
+        counts = np.diff(self.offsets)
+        if perImage is None:
+            rows = np.arange(self.offsets[-1])
+        else:
+            rows = np.concatenate([start + (np.sort(rng.choice(count, perImage, replace=False))
+                                            if count > perImage else np.arange(count))
+                                   for start, count in zip(self.offsets[:-1], counts)] + [np.zeros(0, int)])
+        if limit is not None and len(rows) > limit:
+            rows = np.sort(rng.choice(rows, limit, replace=False))
+        return np.ascontiguousarray(self.data[rows], 'float32')
+
+    def remove(self):
+        self.data = None
+        os.remove(self.path)
+
+def extractDescriptors(imagePaths, directory='.'):
+    '''
+    Runs SIFT over the images and streams the descriptors into a DescriptorStore.
+    '''
+    desc = cv2.xfeatures2d.SIFT_create()
+    store = DescriptorStore(directory, desc.descriptorSize())
+    for imagePath in imagePaths:
+        print(imagePath)
+        kp, des = desc.detectAndCompute(cv2.imread(imagePath), None)
+        store.append(des)
+    return store.finish()
+
+def trainVocabulary(store, numWords, tree=None, perImage=None, chunk=65536):
+    '''
+    Clusters the stored descriptors into a flat k-means vocabulary, or
+    into the given VocabularyTree.
+
+    With perImage set, a sample of at most perImage descriptors of every
+    image is clustered. Otherwise the flat vocabulary is trained by
+    mini-batch k-means streamed over the memory-mapped store, chunk
+    descriptors at a time, and the tree is trained on a bounded random
+    sample (see DescriptorStore.sample), so memory use does not grow with
+    the size of the map.
+    '''
+    if tree is not None:
+        return tree.fit(store.sample(perImage))
+    if perImage is not None:
+        voc, variance = kmeans(store.sample(perImage, limit=None), numWords, 1)
+        return voc
+    clusters = MiniBatchKMeans(n_clusters=numWords, random_state=0)
+    for block in store.chunks(max(chunk, 3*numWords)):
+        clusters.partial_fit(np.asarray(block, 'float32'))
+    return clusters.cluster_centers_.astype('float32')
+
+def quantize(voc, descriptors):
+    if isinstance(voc, VocabularyTree):
+        return voc.quantize(descriptors)
+    words, distance = vq(descriptors, voc)
+    return words
+
+def termFrequencies(store, voc, numWords):
+    '''
+    Sparse (images, words) matrix of visual word counts, built image by image.
+    '''
+    indptr = [0]
+    indices = []
+    counts = []
+    for i in range(len(store)):
+        des = store[i]
+        words = quantize(voc, des) if len(des) else np.zeros(0, int)
+        tf = np.bincount(words, minlength=numWords)
+        present = np.flatnonzero(tf)
+        indices.append(present)
+        counts.append(tf[present])
+        indptr.append(indptr[-1] + len(present))
+    return sparse.csr_matrix((np.concatenate(counts).astype('float32'), np.concatenate(indices), indptr),
+                             shape=(len(store), numWords))
+
+def tfidf(tf):
+    '''
+    Returns the L2-normalized tf-idf matrix and the idf of every word.
+    '''
+    nbr_occurences = np.bincount(tf.indices, minlength=tf.shape[1])
+    idf = np.array(np.log((1.0*tf.shape[0]+1) / (1.0*nbr_occurences + 1)), 'float32')
+    return preprocessing.normalize(tf.multiply(idf[None, :]).tocsr(), norm='l2'), idf
+
+def trainIndex(imagePaths, indexPath, numWords, tree=None, perImage=None):
+    '''
+    Trains the dictionary of one location and writes it as the tuple
+    (im_features, image_paths, idf, numWords, voc) read by BOWIndex.
+    Descriptors are kept on disk while training; perImage limits how
+    many descriptors of each image are used for clustering.
+    '''
+    store = extractDescriptors(imagePaths, os.path.dirname(indexPath) or '.')
+    try:
+        voc = trainVocabulary(store, numWords, tree, perImage)
+        if tree is not None:
+            numWords = tree.numWords
+        im_features, idf = tfidf(termFrequencies(store, voc, numWords))
+    finally:
+        store.remove()
+
+    # Stored uncompressed so that the dictionary can be memory-mapped when loaded
+    joblib.dump((im_features.toarray(), imagePaths, idf, numWords, voc), indexPath)
+
+
+#########################
+### Map-Wide Indexing ###
+#########################
+
+def loadMapIndex(indexPath):
+    '''
+    Returns the MapBOW index of a map-wide dictionary, loading it on first use.
+    '''
+    mtime = os.path.getmtime(indexPath)
+    index = loadedIndices.get(indexPath)
+    if index is None or index.mtime != mtime:
+        index = MapBOW(indexPath)
+        loadedIndices[indexPath] = index
+    return index
+
+def trainMapIndex(locations, indexPath, numWords, extension='.png', perImage=None):
+    '''
+    Trains one vocabulary over every image of every location and writes the
+    map-wide tf-idf index, stored as an inverted file from each visual word
+    to the images that contain it.
+    '''
+    image_paths = []
+    for location in locations:
+        image_paths.extend(sorted(glob.glob(location + '/*' + extension)))
+
+    store = extractDescriptors(image_paths, os.path.dirname(indexPath) or '.')
+    try:
+        voc = trainVocabulary(store, numWords, perImage=perImage)
+        im_features, idf = tfidf(termFrequencies(store, voc, numWords))
+    finally:
+        store.remove()
+
+    # Columns of the tf-idf matrix are the postings lists of the inverted file
+    postings = im_features.tocsc()
+    joblib.dump({'image_paths': image_paths, 'idf': idf, 'voc': voc,
+                 'indptr': postings.indptr, 'images': postings.indices,
+                 'weights': postings.data.astype('float32')}, indexPath)
+
+
+class MapBOW(object):
+    '''
+    Map-wide Bag-of-Words index with a single vocabulary. A query is
+    quantized once and its score for every map image is accumulated
+    from the postings of the words it contains.
+    '''
+
+    def __init__(self, indexPath):
+        self.path = indexPath
+        self.mtime = os.path.getmtime(indexPath)
+        index = joblib.load(indexPath, mmap_mode='r')
+        self.image_paths = index['image_paths']
+        self.idf = index['idf']
+        self.voc = index['voc']
+        self.indptr = index['indptr']
+        self.images = index['images']
+        self.weights = index['weights']
+        self.locations = np.array([os.path.dirname(path) for path in self.image_paths])
+
+    def score(self, descriptors):
+        '''
+        Cosine similarity between the query and every map image, in the
+        order of image_paths.
+        '''
+        if descriptors is None or len(descriptors) == 0:
+            return np.zeros(len(self.image_paths), 'float32')
+        words, distance = vq(descriptors, self.voc)
+        words, counts = np.unique(words, return_counts=True)
+        query = counts * self.idf[words]
+        query /= max(np.linalg.norm(query), 1e-12)
+
+        # Gather the postings of every query word and accumulate them at once
+        start = self.indptr[words]
+        lengths = self.indptr[words+1] - start
+        postings = np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.bincount(self.images[postings], weights=np.repeat(query, lengths) * self.weights[postings],
+                           minlength=len(self.image_paths)).astype('float32')
+
+    def locationScores(self, scores, location):
+        '''
+        Scores of the images of one location, e.g. 'map/3', in angle order.
+        '''
+        return scores[self.locations == location.rstrip('/')]
+
+
+#######################
+### Vocabulary Tree ###
+#######################
+
+def clusterNode(descriptors, branching, seed):
+    '''
+    Splits the descriptors of one tree node into `branching` clusters with
+    mini-batch k-means. Nodes with too few descriptors repeat them as centers.
+    '''
+    if len(descriptors) == 0:
+        return np.zeros((branching, descriptors.shape[1]), 'float32')
+    if len(descriptors) < branching:
+        return descriptors[np.arange(branching) % len(descriptors)].astype('float32')
+    kmeans = MiniBatchKMeans(n_clusters=branching, batch_size=max(1024, 4*branching),
+                             n_init=3, random_state=seed)
+    return kmeans.fit(descriptors).cluster_centers_.astype('float32')
+
+def nearestCenter(descriptors, centers):
+    '''
+    Index of the closest center for each descriptor, or, for a (n, k, dim)
+    array of centers, the closest of each descriptor's own k centers.
+    '''
+    if centers.ndim == 2:
+        return (np.dot(descriptors, -2 * centers.T) + (centers ** 2).sum(axis=1)).argmin(axis=1)
+    diff = descriptors[:, None, :] - centers
+    return np.einsum('ijk,ijk->ij', diff, diff).argmin(axis=1)
+
+def fitLevels(descriptors, branching, depth, seed):
+    '''
+    Hierarchical k-means below one node. Returns the centers of each level
+    of the subtree, where the children of the node at position p of a
+    level sit at positions p*branching .. p*branching+branching-1 of the next.
+    '''
+    centers = clusterNode(descriptors, branching, seed)
+    if depth == 1:
+        return [centers]
+    labels = nearestCenter(descriptors, centers) if len(descriptors) else np.zeros(0, int)
+    subtrees = [fitLevels(descriptors[labels == c], branching, depth-1, seed) for c in range(branching)]
+    return [centers] + [np.concatenate([subtree[l] for subtree in subtrees]) for l in range(depth-1)]
+
+
+class VocabularyTree(object):
+    '''
+    Vocabulary built by hierarchical k-means. A descriptor is quantized by
+    descending from the root to the closest child at every level, which
+    costs branching x depth distance computations, and its visual word is
+    the leaf it reaches.
+    '''
+
+    def __init__(self, branching=10, depth=4, n_jobs=-1):
+        self.branching = branching
+        self.depth = depth
+        self.n_jobs = n_jobs
+        self.numWords = branching ** depth
+        self.levels = []
+
+    def fit(self, descriptors, seed=0):
+        '''
+        Trains the tree. Below the root, the branches are trained in parallel
+        by n_jobs processes.
+        '''
+        descriptors = np.asarray(descriptors, 'float32')
+        root = clusterNode(descriptors, self.branching, seed)
+        if self.depth == 1:
+            self.levels = [root]
+            return self
+        labels = nearestCenter(descriptors, root)
+        subtrees = joblib.Parallel(n_jobs=self.n_jobs)(
+            joblib.delayed(fitLevels)(descriptors[labels == c], self.branching, self.depth-1, seed)
+            for c in range(self.branching))
+        self.levels = [root] + [np.concatenate([subtree[l] for subtree in subtrees])
+                                for l in range(self.depth-1)]
+        return self
+
+    def quantize(self, descriptors, chunk=4096):
+        '''
+        Returns the visual word of each descriptor.
+        '''
+        descriptors = np.asarray(descriptors, 'float32')
+        words = np.zeros(len(descriptors), int)
+        steps = np.arange(self.branching)
+        for start in range(0, len(descriptors), chunk):
+            block = descriptors[start:start+chunk]
+            node = np.zeros(len(block), int)
+            for centers in self.levels:
+                children = node[:, None] * self.branching + steps
+                node = children[np.arange(len(block)), nearestCenter(block, centers[children])]
+            words[start:start+chunk] = node
+        return words
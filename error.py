@@ -1,32 +1,19 @@
 import math
+import numpy as np
+
+import probStore
 
 #####################
 ### Reading files ###
 #####################
 
 def readProb(filename):
-    '''this function reads the content of a txt file, turn the data into  dictionaries of 
-    circles'''
-    file = open(filename, 'r') 
-    content = file.read().split('\n')[:-1]
-    probDict = {}
-    counter = 0
-    for i in range(len(content))[::6]:
-        name = str(counter).zfill(4)
-        L1 = list(map(float, content[i+1].replace('[','').replace(']','').split(',')))
-        L2 = list(map(float, content[i+3].replace('[','').replace(']','').split(',')))
-        L3 = list(map(float, content[i+5].replace('[','').replace(']','').split(',')))
-        probDict[name] = [[float(content[i]), L1], [float(content[i+2]), L2], [float(content[i+4]), L3]]
-        counter += 1
-    return probDict
+    '''this function reads a binary probability file as a (frames, locations, 1 + angles) array'''
+    return probStore.readFrames(filename)
 
 def readBestGuess(filename):
     '''this function reads the list of best guesses of the robot's position at every position'''
-    file = open(filename, 'r')
-    content = file.read().split('\n')[:-1]
-    content = list(map(int, content))
-    bestGuesses = [[content[x], content[x+1]] for x in range(len(content) - 1 ) [::2]]
-    return bestGuesses
+    return probStore.readFrames(filename).tolist()
 
 def readCoord(filename):
     file = open(filename, 'r')
@@ -40,28 +27,14 @@ def readCoord(filename):
 
 def successMetric():
     ''' this function calculate the differences between best guesses and the true values'''
-    bestGuess = readBestGuess('bestGuess.txt')
+    bestGuess = readBestGuess('bestGuess.bin')
     # best Guess contains a list of lists. First elements is the index of the best cirlce, second element is the index
     # of the best angle
     coordinates = readCoord('coord.txt')
     # coordinates is the "real" position of the robot as analyzed by the image matching algorithm
     # the first two points of coordinates is the position of the robot, the second set of points
     # are direction of the angle 
-
-    success = []
-    for i in range(len(bestGuess)):
-        bestGuessAngle = bestGuess[i][1]*15
-        positions = []
-        bestGuessCircle = bestGuess[i][0]
-        robotPos = coordinates[i][:2]
-        robotDir = coordinates[i][2:]
-        angle = math.atan2(robotDir[1] - robotPos[1], robotDir[0] - robotPos[0])
-        angle = angle*180./math.pi + 90
-        if angle < 0:
-            angle += 360
-        success.append(abs(angle-bestGuessAngle) < 30)
-        
-    return success.count(True)/len(success)
+    return float(successScores(bestGuess, coordinates))
 
 ######################
 ### Modal Variance ###
@@ -69,30 +42,9 @@ def successMetric():
 
 def modalMetric():
     ''' this function calculate the differences between best guesses and the true values'''
-    bestGuess = readBestGuess('bestGuess.txt')
-    # best Guess contains a list of lists. First elements is the index of the best cirlce, second element is the index
-    # of the best angle
+    bestGuess = readBestGuess('bestGuess.bin')
     coordinates = readCoord('coord.txt')
-    # coordinates is the "real" position of the robot as analyzed by the image matching algorithm
-    # the first two points of coordinates is the position of the robot, the second set of points
-    # are direction of the angle 
-    angleError = 0
-    for i in range(len(bestGuess)):
-        bestGuessAngle = bestGuess[i][1] * 15
-        robotPos = coordinates[i][:2]
-        robotDir = coordinates[i][2:]
-        angle = math.atan2(robotDir[1] - robotPos[1], robotDir[0] - robotPos[0])
-        angle *= 180./math.pi
-        angle += 90
-        if angle <= 0:
-            angle += 360
-        if bestGuessAngle == 0 and angle > 300:
-            bestGuessAngle = 360
-        elif bestGuessAngle == 360 and angle < 60:
-            bestGuessAngle = 0
-        angleError += (bestGuessAngle - angle)**2
-
-    return math.sqrt(angleError)
+    return float(modalScores(bestGuess, coordinates))
 
 ########################################
 ### Average Probabilitistic Variance ###
@@ -100,34 +52,53 @@ def modalMetric():
 
 def errorMetric():
     ''' this function calculate the differences between best guesses and the true values'''
-    bestGuess = readBestGuess('bestGuess.txt')
-    # best Guess contains a list of lists. First elements is the index of the best cirlce, second element is the index
-    # of the best angle
+    bestGuess = np.array(readBestGuess('bestGuess.bin'))
     coordinates = readCoord('coord.txt')
-    # coordinates is the "real" position of the robot as analyzed by the image matching algorithm
-    # the first two points of coordinates is the position of the robot, the second set of points
-    # are direction of the angle 
+    probs = readProb('out.bin')
+
+    # the probability lists of the best guessed circles
+    predictedAngles = probs[np.arange(len(bestGuess)), bestGuess[:, 0], 1:]
+    return float(errorScores(predictedAngles, coordinates))
+
+#########################
+### Vectorized Scores ###
+#########################
+
+def robotAngles(coordinates, count):
+    ''' this function calculates the true angle of the robot in degrees, starting from
+    the top and before wrapping negative angles, for the first count frames'''
+    coordinates = np.asarray(coordinates, np.float64)[:count]
+    robotPos = coordinates[:, :2]
+    robotDir = coordinates[:, 2:]
+    angle = np.arctan2(robotDir[:, 1] - robotPos[:, 1], robotDir[:, 0] - robotPos[:, 0])
+    return angle*180./math.pi + 90
+
+def successScores(bestGuess, coordinates):
+    ''' the fraction of best guessed angles within 30 degrees of the truth. bestGuess
+    is a (..., frames, 2) array, so that many runs can be scored at once'''
+    bestGuess = np.asarray(bestGuess)
+    angle = robotAngles(coordinates, bestGuess.shape[-2])
+    angle = np.where(angle < 0, angle + 360, angle)
+    bestGuessAngle = bestGuess[..., 1]*15
+    return (np.abs(angle - bestGuessAngle) < 30).mean(axis=-1)
+
+def modalScores(bestGuess, coordinates):
+    ''' the root of the summed squared errors of the best guessed angles'''
+    bestGuess = np.asarray(bestGuess)
+    angle = robotAngles(coordinates, bestGuess.shape[-2])
+    angle = np.where(angle <= 0, angle + 360, angle)
+    bestGuessAngle = bestGuess[..., 1]*15
+    bestGuessAngle = np.where((bestGuessAngle == 0) & (angle > 300), 360, bestGuessAngle)
+    bestGuessAngle = np.where((bestGuessAngle == 360) & (angle < 60), 0, bestGuessAngle)
+    return np.sqrt(((bestGuessAngle - angle)**2).sum(axis=-1))
 
-    probD = readProb('out.txt')
-
-    L= []
-    for key, value in probD.items():
-        index = int(key)
-        bestGuessAngle = bestGuess[index][1]*15
-        bestGuessCircle = bestGuess[index][0]
-        predictedAngles = value[bestGuessCircle][1]
-        angleError = 0
-        robotPos = coordinates[index][:2]
-        robotDir = coordinates[index][2:]
-        angle = math.atan2(robotDir[1] - robotPos[1], robotDir[0] - robotPos[0])
-        angle = angle*180./math.pi + 90
-        if angle < 0:
-            angle += 360
-        for i in range(len(predictedAngles)):
-            prob = predictedAngles[i]
-            predAngle = i*15
-            angleError += prob * (predAngle - angle)**2
-        L.append(angleError)
-        
-    return sum(L)/len(L)
-            
\ No newline at end of file
+def errorScores(predictedAngles, coordinates):
+    ''' the average over frames of the probability-weighted squared angle error.
+    predictedAngles is a (..., frames, angles) array of the probabilities of the best
+    guessed circles'''
+    predictedAngles = np.asarray(predictedAngles)
+    angle = robotAngles(coordinates, predictedAngles.shape[-2])
+    angle = np.where(angle < 0, angle + 360, angle)
+    predAngle = np.arange(predictedAngles.shape[-1])*15
+    angleError = (predictedAngles * (predAngle - angle[:, None])**2).sum(axis=-1)
+    return angleError.mean(axis=-1)
@@ -0,0 +1,445 @@
+'''
+Persistent Feature Index
+========================
+
+Stores the keypoints and descriptors of every image in a map
+location on disk, so that feature extraction only runs for
+map images that have changed since the index was written.
+
+Each location is kept in its own folder under `index/<algorithm>/`:
+
+    descriptors.npy   all descriptors of the location, stacked
+    keypoints.npy     structured array of keypoint attributes
+    offsets.npy       row offsets of each image into the arrays above
+    manifest.json     image names, sizes, modification times and hashes
+    flann.idx         FLANN index over all descriptors of the location
+    pq_64x16.npz      PCA and product-quantized codes of the descriptors
+
+The arrays are loaded memory-mapped, so opening an index costs
+a few file reads regardless of its size. Indices with a keypoint
+budget are kept under `index/<algorithm>_<budget>/` instead.
+
+Usage:
+------
+    python featureIndex.py -d [<directory>] -a [<algorithm>] -b [<keypoints>]
+'''
+
+import cv2
+import numpy as np
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+
+import pq
+from hamming import HammingMatcher, LSHIndex
+
+extension = '.png'
+indexRoot = 'index'
+
+FLANN_INDEX_KDTREE = 1
+
+keypointType = np.dtype([('x', 'f4'), ('y', 'f4'), ('size', 'f4'), ('angle', 'f4'),
+                         ('response', 'f4'), ('octave', 'i4'), ('class_id', 'i4')])
+
+
+def packKeypoints(keypoints):
+    '''
+    Converts a list of cv2.KeyPoint into a structured array.
+    '''
+    packed = np.zeros(len(keypoints), keypointType)
+    for i, kp in enumerate(keypoints):
+        packed[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+    return packed
+
+def unpackKeypoints(packed):
+    '''
+    Converts a structured keypoint array back into a list of cv2.KeyPoint,
+    e.g. for cv2.drawMatches.
+    '''
+    return [cv2.KeyPoint(float(k['x']), float(k['y']), float(k['size']), float(k['angle']),
+                         float(k['response']), int(k['octave']), int(k['class_id'])) for k in packed]
+
+def createDetector(algorithm):
+    '''
+    Creates the feature detector of an algorithm. BOW uses SIFT descriptors;
+    color matching needs no detector.
+    '''
+    if algorithm == 'SURF':
+        return cv2.xfeatures2d.SURF_create()
+    elif algorithm == 'SIFT' or algorithm == 'BOW' or algorithm == 'MapBOW':
+        return cv2.xfeatures2d.SIFT_create()
+    elif algorithm == 'ORB':
+        return cv2.ORB_create()
+    return None
+
+def descriptorType(detector):
+    if detector.descriptorType() == cv2.CV_8U:
+        return np.uint8
+    return np.float32
+
+def selectKeypoints(keypoints, descriptors, budget, grid=None, shape=None):
+    '''
+    Keeps at most budget keypoints, the strongest by detector response.
+    With grid set, the image of the given shape is split into grid x grid
+    cells that each keep their strongest budget // grid**2 keypoints first,
+    and the rest of the budget goes to the strongest remaining keypoints,
+    so that textured regions cannot take the whole budget.
+    '''
+    if budget is None or len(keypoints) <= budget:
+        return keypoints, descriptors
+    order = np.argsort(-np.array([kp.response for kp in keypoints]), kind='stable')
+    keep = np.zeros(len(keypoints), bool)
+
+    if grid:
+        height, width = shape[:2]
+        points = np.array([kp.pt for kp in keypoints])
+        rows = np.minimum((points[:, 1] * grid / height).astype(int), grid - 1)
+        cols = np.minimum((points[:, 0] * grid / width).astype(int), grid - 1)
+        cells = rows * grid + cols
+        # rank of every keypoint by response within its cell
+        byCell = order[np.argsort(cells[order], kind='stable')]
+        sortedCells = cells[byCell]
+        rank = np.arange(len(byCell)) - np.searchsorted(sortedCells, sortedCells)
+        keep[byCell[rank < budget // grid**2]] = True
+
+    remaining = order[~keep[order]]
+    keep[remaining[:budget - keep.sum()]] = True
+    selected = order[keep[order]]
+    return [keypoints[i] for i in selected], descriptors[selected]
+
+def detectFeatures(detector, image, budget=None, grid=None):
+    '''
+    Detects the keypoints and descriptors of an image, keeping at most
+    budget keypoints, see selectKeypoints. Used for both the map and the
+    query so that they are limited the same way.
+    '''
+    kp, des = detector.detectAndCompute(image, None)
+    if des is None:
+        return kp, des
+    return selectKeypoints(kp, des, budget, grid, image.shape)
+
+def extractFeatures(detector, imagePath, budget=None, grid=None):
+    '''
+    Returns the packed keypoints, descriptors and shape of a map image.
+    '''
+    image = cv2.imread(imagePath)
+    kp, des = detectFeatures(detector, image, budget, grid)
+    if des is None:
+        des = np.zeros((0, detector.descriptorSize()), descriptorType(detector))
+    return packKeypoints(kp), des, list(image.shape)
+
+def fileHash(imagePath):
+    sha = hashlib.sha1()
+    with open(imagePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def indexName(algorithm, budget=None, grid=None):
+    '''
+    Folder name of the indices of an algorithm and keypoint budget, e.g.
+    SIFT, SIFT_500 or SIFT_500_4x4.
+    '''
+    if budget is None:
+        return algorithm
+    if grid:
+        return '%s_%d_%dx%d' % (algorithm, budget, grid, grid)
+    return '%s_%d' % (algorithm, budget)
+
+
+class FeatureIndex(object):
+
+    def __init__(self, data, algorithm, root=indexRoot, budget=None, grid=None):
+        '''
+        With a budget, at most budget keypoints are kept per image, see
+        selectKeypoints. Every budget is stored in its own folder.
+        '''
+        self.data = data
+        self.alg = algorithm
+        self.budget = budget
+        self.grid = grid
+        self.path = os.path.join(root, indexName(algorithm, budget, grid), data.strip('/').replace('/', '_'))
+        self.names = []
+        self.entries = []
+        self.lookup = {}
+        self.offsets = np.zeros(1, np.int64)
+        self.keypoints = np.zeros(0, keypointType)
+        self.descriptors = None
+        self.flann = None
+        self.flannData = None
+        self.hamming = {}
+        self.compressed = {}
+
+    ####################
+    ### Index Access ###
+    ####################
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, imagePath):
+        return os.path.basename(imagePath) in self.lookup
+
+    def __getitem__(self, imagePath):
+        '''
+        Returns the (keypoints, descriptors) of a map image, as slices of
+        the memory-mapped arrays.
+        '''
+        i = self.lookup[os.path.basename(imagePath)]
+        start, end = self.offsets[i], self.offsets[i+1]
+        return self.keypoints[start:end], self.descriptors[start:end]
+
+    def keys(self):
+        return [os.path.join(self.data, name) for name in self.names]
+
+    def labels(self):
+        '''
+        Image number of every descriptor row.
+        '''
+        return np.repeat(np.arange(len(self.names)), np.diff(self.offsets))
+
+    ##########################
+    ### Loading and Saving ###
+    ##########################
+
+    def load(self):
+        '''
+        Opens a previously written index. Returns False if there is none.
+        '''
+        manifestPath = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(manifestPath):
+            return False
+        with open(manifestPath, 'r') as f:
+            manifest = json.load(f)
+        if manifest['algorithm'] != self.alg or manifest.get('budget') != self.budget or manifest.get('grid') != self.grid:
+            return False
+        self.entries = manifest['images']
+        self.names = [entry['name'] for entry in self.entries]
+        self.lookup = dict((name, i) for i, name in enumerate(self.names))
+        self.offsets = np.load(os.path.join(self.path, 'offsets.npy'))
+        self.keypoints = np.load(os.path.join(self.path, 'keypoints.npy'), mmap_mode='r')
+        self.descriptors = np.load(os.path.join(self.path, 'descriptors.npy'), mmap_mode='r')
+        self.flann = None
+        self.flannData = None
+        self.hamming = {}
+        self.compressed = {}
+        return True
+
+    def flannIndex(self):
+        '''
+        Returns a single FLANN index over the descriptors of every image in
+        the location. The built index is saved next to the descriptors and
+        reloaded on later runs. It is written under a temporary name first,
+        so that other processes never load part of it.
+        '''
+        if self.flann is None:
+            # FLANN keeps a reference to the data, so it must stay in memory
+            self.flannData = np.ascontiguousarray(self.descriptors, np.float32)
+            flannPath = os.path.join(self.path, 'flann.idx')
+            self.flann = cv2.flann_Index()
+            if not (os.path.exists(flannPath) and self.flann.load(self.flannData, flannPath)):
+                self.flann = cv2.flann_Index(self.flannData, dict(algorithm=FLANN_INDEX_KDTREE, trees=5))
+                temporary = '%s.%d.tmp' % (flannPath, os.getpid())
+                self.flann.save(temporary)
+                os.replace(temporary, flannPath)
+        return self.flann
+
+    def compressedIndex(self, dims=64, subspaces=16):
+        '''
+        Returns the PCA and product-quantized index of the descriptors of the
+        location, see pq.CompressedIndex. It is saved next to the descriptors
+        and reloaded on later runs. The raw descriptors stay memory-mapped on
+        disk for exact re-ranking.
+        '''
+        if (dims, subspaces) not in self.compressed:
+            pqPath = os.path.join(self.path, 'pq_%dx%d.npz' % (dims, subspaces))
+            if os.path.exists(pqPath):
+                index = pq.CompressedIndex.load(pqPath, self.descriptors)
+            else:
+                index = pq.CompressedIndex.build(self.descriptors, dims, subspaces)
+                index.save(pqPath)
+            self.compressed[(dims, subspaces)] = index
+        return self.compressed[(dims, subspaces)]
+
+    def hammingMatcher(self, lsh=False):
+        '''
+        Returns a batched Hamming matcher over the binary descriptors of
+        the location, optionally backed by a multi-probe LSH index.
+        '''
+        if lsh not in self.hamming:
+            descriptors = np.ascontiguousarray(self.descriptors)
+            if lsh:
+                self.hamming[lsh] = LSHIndex(descriptors, self.offsets)
+            else:
+                self.hamming[lsh] = HammingMatcher(descriptors, self.offsets)
+        return self.hamming[lsh]
+
+    def signature(self, imagePath, previous=None):
+        '''
+        Describes a map image file. The hash is only recomputed when the size
+        or modification time differ from the previous entry.
+        '''
+        stat = os.stat(imagePath)
+        entry = {'name': os.path.basename(imagePath), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        if previous is not None and previous['size'] == entry['size'] and previous['mtime'] == entry['mtime']:
+            entry['sha1'] = previous['sha1']
+        else:
+            entry['sha1'] = fileHash(imagePath)
+        return entry
+
+    def pending(self):
+        '''
+        Returns the map images that are new or changed since the index was written.
+        '''
+        self.load()
+        previous = dict(zip(self.names, self.entries))
+        imagePaths = []
+        for imagePath in sorted(glob.glob(self.data + '/*' + extension)):
+            old = previous.get(os.path.basename(imagePath))
+            if old is None or old['sha1'] != self.signature(imagePath, old)['sha1']:
+                imagePaths.append(imagePath)
+        return imagePaths
+
+    def update(self, detector, computed=None):
+        '''
+        Brings the index up to date with the images in the location, running
+        the detector only on images that are new or whose contents changed.
+        Features already extracted elsewhere can be passed in computed, as a
+        dictionary from image path to the result of extractFeatures.
+        '''
+        self.load()
+        previous = dict(zip(self.names, self.entries))
+        computed = computed or {}
+
+        imagePaths = sorted(glob.glob(self.data + '/*' + extension))
+        entries = []
+        features = []
+        changed = 0
+        for imagePath in imagePaths:
+            old = previous.get(os.path.basename(imagePath))
+            entry = self.signature(imagePath, old)
+            if old is not None and old['sha1'] == entry['sha1']:
+                kp, des = self[imagePath]
+                entry['shape'] = old['shape']
+            else:
+                if imagePath in computed:
+                    kp, des, entry['shape'] = computed[imagePath]
+                else:
+                    kp, des, entry['shape'] = extractFeatures(detector, imagePath, self.budget, self.grid)
+                changed += 1
+            entries.append(entry)
+            features.append((kp, des))
+
+        if changed or entries != self.entries:
+            self.save(entries, features, detector)
+        return self
+
+    def save(self, entries, features, detector):
+        '''
+        Writes the features of a location as contiguous arrays. Arrays are
+        written to temporary files first so that open memory maps stay valid.
+        '''
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        counts = [len(des) for kp, des in features]
+        offsets = np.zeros(len(features) + 1, np.int64)
+        offsets[1:] = np.cumsum(counts)
+        total = int(offsets[-1])
+
+        keypoints = np.lib.format.open_memmap(os.path.join(self.path, 'keypoints.tmp.npy'), 'w+',
+                                              keypointType, (total,))
+        descriptors = np.lib.format.open_memmap(os.path.join(self.path, 'descriptors.tmp.npy'), 'w+',
+                                                descriptorType(detector), (total, detector.descriptorSize()))
+        for i, (kp, des) in enumerate(features):
+            keypoints[offsets[i]:offsets[i+1]] = kp
+            descriptors[offsets[i]:offsets[i+1]] = des
+        keypoints.flush()
+        descriptors.flush()
+        del keypoints, descriptors
+
+        np.save(os.path.join(self.path, 'offsets.npy'), offsets)
+        for stale in [os.path.join(self.path, 'flann.idx')] + glob.glob(os.path.join(self.path, 'pq_*.npz')):
+            if os.path.exists(stale):
+                os.remove(stale)
+        os.replace(os.path.join(self.path, 'keypoints.tmp.npy'), os.path.join(self.path, 'keypoints.npy'))
+        os.replace(os.path.join(self.path, 'descriptors.tmp.npy'), os.path.join(self.path, 'descriptors.npy'))
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump({'algorithm': self.alg, 'budget': self.budget, 'grid': self.grid, 'images': entries}, f, indent=1)
+
+        self.load()
+
+
+#########################
+### Parallel Building ###
+#########################
+
+# Detector and keypoint budget of an extraction worker process, set once by initExtractor
+workerDetector = None
+workerBudget = (None, None)
+
+def initExtractor(algorithm, budget=None, grid=None):
+    global workerDetector, workerBudget
+    cv2.setNumThreads(1)
+    workerDetector = createDetector(algorithm)
+    workerBudget = (budget, grid)
+
+def extractWorker(task):
+    location, imagePath = task
+    return location, imagePath, extractFeatures(workerDetector, imagePath, *workerBudget)
+
+def buildIndices(locations, algorithm, workers=None, root=indexRoot, budget=None, grid=None):
+    '''
+    Brings the feature indices of several locations up to date, extracting
+    the images of all locations in a process pool. Each location's index
+    is written as soon as its last image is done.
+    '''
+    indices = [FeatureIndex(location, algorithm, root, budget, grid) for location in locations]
+    detector = createDetector(algorithm)
+    pending = [index.pending() for index in indices]
+    computed = [{} for index in indices]
+    tasks = [(i, imagePath) for i in range(len(indices)) for imagePath in pending[i]]
+
+    for i, index in enumerate(indices):
+        if not pending[i]:
+            index.update(detector)
+    if not tasks:
+        return indices
+
+    done = 0
+    pool = multiprocessing.Pool(workers, initializer=initExtractor, initargs=(algorithm, budget, grid))
+    try:
+        for i, imagePath, features in pool.imap_unordered(extractWorker, tasks):
+            computed[i][imagePath] = features
+            done += 1
+            if len(computed[i]) == len(pending[i]):
+                indices[i].update(detector, computed[i])
+                print('Indexed %s (%d/%d images)' % (locations[i], done, len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    return indices
+
+
+if __name__ == '__main__':
+    from Matcher import Matcher
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-d', '--dataset', required=True,
+        help='Path to the directory containing map images')
+    ap.add_argument('-a', '--algorithm', default='SIFT',
+        help='Feature algorithm: SIFT, SURF, or ORB')
+    ap.add_argument('-b', '--budget', type=int, default=None,
+        help='Maximum number of keypoints per image')
+    ap.add_argument('-g', '--grid', type=int, default=None,
+        help='Spread the keypoint budget over a grid of this many cells per side')
+    args = vars(ap.parse_args())
+
+    matcher = Matcher(args['algorithm'], budget=args['budget'], grid=args['grid'])
+    matcher.setDirectory(args['dataset'])
+    index = matcher.createFeatureIndex()
+    print('%d images, %d descriptors' % (len(index), index.offsets[-1]))
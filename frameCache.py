@@ -0,0 +1,128 @@
+'''
+Frame Cache
+===========
+
+Content-addressed cache of the per-frame work done on camera
+frames: the blur factor, the preprocessed query image, its
+keypoints and descriptors, and its color histogram. Reruns over
+the same log read them back instead of recomputing them.
+
+An entry is keyed by the SHA-1 of the data it was computed from,
+either the frame file or the preprocessed query image, together
+with every parameter of the computation, so a change of resolution,
+algorithm or keypoint budget never returns a stale entry. Entries
+are single .npz files under `cache/<2 hex digits>/`; query images
+are stored PNG-encoded and descriptors compressed.
+
+The cache is bounded: when its size passes the capacity, the least
+recently used entries are removed until it is back under 90% of it.
+Reading an entry marks it as used.
+'''
+
+import hashlib
+import io
+import os
+import numpy as np
+
+
+def digest(data):
+    '''
+    SHA-1 of the bytes of a file or of an image array.
+    '''
+    sha = hashlib.sha1()
+    if isinstance(data, np.ndarray):
+        sha.update(repr((data.shape, data.dtype.str)).encode('ascii'))
+        data = np.ascontiguousarray(data)
+    sha.update(memoryview(data).cast('B'))
+    return sha.hexdigest()
+
+
+class FrameCache(object):
+
+    def __init__(self, root='cache', capacity=1 << 30):
+        '''
+        capacity is the size cap in bytes.
+        '''
+        self.root = root
+        self.capacity = capacity
+        self.size = sum(size for path, used, size in self.entries())
+
+    def key(self, source, *params):
+        '''
+        The key of an artifact computed from data with the given digest
+        by a computation described by params.
+        '''
+        return hashlib.sha1(repr((source,) + params).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npz')
+
+    def entries(self):
+        '''
+        (path, last use, size) of every entry.
+        '''
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for folder in os.scandir(self.root):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith('.npz'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def get(self, key):
+        '''
+        Returns the dictionary of arrays stored under key, or None.
+        '''
+        path = self.path(key)
+        try:
+            with np.load(path) as stored:
+                arrays = dict((name, stored[name]) for name in stored.files)
+            os.utime(path, None)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, **arrays):
+        '''
+        Stores arrays under key. The file is written under a temporary name
+        first, so that concurrent readers and writers never see part of it.
+        '''
+        path = self.path(key)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as file:
+            file.write(buffer.getvalue())
+        os.replace(temporary, path)
+        self.size += len(buffer.getvalue())
+        if self.size > self.capacity:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache is under 90%
+        of its capacity. Sizes are rescanned, as other processes may share it.
+        '''
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for path, used, size in entries)
+        for path, used, size in entries:
+            if self.size <= 0.9 * self.capacity:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for path, used, size in self.entries():
+            os.remove(path)
+        self.size = 0
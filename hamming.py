@@ -0,0 +1,202 @@
+'''
+Hamming Matching
+================
+
+Batched matching of binary descriptors, such as ORB, against
+every image of a location at once. Distances are popcounts over
+the XOR of packed descriptor bits, computed in NumPy.
+
+Matching follows the cross-checked brute-force matcher: a query
+descriptor matches an image if its nearest neighbour in that image
+has the query descriptor as its own nearest neighbour.
+
+For large maps, LSHIndex restricts the distance computations to
+candidates found by multi-probe locality-sensitive hashing.
+'''
+
+import numpy as np
+
+popcountTable = np.array([bin(i).count('1') for i in range(256)], np.uint16)
+
+
+def packWords(descriptors):
+    '''
+    Views uint8 descriptors as 64-bit words when their length allows it,
+    so that XOR and popcount touch 8 bytes at a time.
+    '''
+    if descriptors.dtype == np.uint64:
+        return descriptors
+    descriptors = np.ascontiguousarray(descriptors, np.uint8)
+    if hasattr(np, 'bitwise_count') and descriptors.shape[1] % 8 == 0:
+        return descriptors.view(np.uint64)
+    return descriptors
+
+def popcount(words):
+    '''
+    Number of set bits of each element.
+    '''
+    if words.dtype == np.uint64:
+        return np.bitwise_count(words).astype(np.uint16)
+    return popcountTable[words]
+
+def hammingDistance(query, train, chunk=256):
+    '''
+    Returns the (len(query), len(train)) matrix of Hamming distances.
+    Distances are accumulated one word at a time over chunks of queries,
+    which keeps every intermediate array two-dimensional and bounded.
+    '''
+    query = packWords(query)
+    train = packWords(train)
+    dists = np.zeros((len(query), len(train)), np.uint16)
+    for start in range(0, len(query), chunk):
+        block = query[start:start+chunk]
+        for w in range(query.shape[1]):
+            dists[start:start+chunk] += popcount(block[:, w:w+1] ^ train[None, :, w])
+    return dists
+
+def crossCheckVotes(dists, offsets):
+    '''
+    Counts the cross-checked matches between the query and each image, given
+    the distances to all descriptors of a location and the per-image offsets.
+    '''
+    numImages = len(offsets) - 1
+    votes = np.zeros(numImages, int)
+    nonEmpty = np.diff(offsets) > 0
+    if len(dists) == 0 or not nonEmpty.any():
+        return votes
+
+    starts = offsets[:-1][nonEmpty]
+    numTrain = dists.shape[1]
+
+    # Ties go to the first descriptor, as with cv2.BFMatcher: folding the
+    # column number into the distance makes every minimum unique
+    keyType = np.int32 if (int(dists.max()) + 1) * numTrain < 2**31 else np.int64
+    keys = dists.astype(keyType) * keyType(numTrain) + np.arange(numTrain, dtype=keyType)
+    rowBest = np.minimum.reduceat(keys, starts, axis=1) % numTrain
+    colBest = dists.argmin(axis=0)
+    votes[nonEmpty] = (colBest[rowBest] == np.arange(len(dists))[:, None]).sum(axis=0)
+    return votes
+
+
+class HammingMatcher(object):
+
+    def __init__(self, descriptors, offsets):
+        self.train = packWords(descriptors)
+        self.offsets = np.asarray(offsets)
+
+    def match(self, query):
+        '''
+        Returns the number of matches of the query in each image.
+        '''
+        if query is None or len(query) == 0:
+            return np.zeros(len(self.offsets) - 1, int)
+        return crossCheckVotes(hammingDistance(query, self.train), self.offsets)
+
+    def matchBatch(self, queries):
+        '''
+        match for several queries, e.g. frames from different robots, with
+        the distances of all their descriptors computed in one pass. The
+        cross check is done for each query on its own rows.
+        '''
+        sizes = [0 if query is None else len(query) for query in queries]
+        if sum(sizes) == 0:
+            return [self.match(query) for query in queries]
+        dists = hammingDistance(np.vstack([query for query in queries if query is not None and len(query)]),
+                                self.train)
+        starts = np.cumsum([0] + sizes[:-1])
+        return [crossCheckVotes(dists[start:start+size], self.offsets) for start, size in zip(starts, sizes)]
+
+
+class LSHIndex(object):
+    '''
+    Multi-probe LSH over binary descriptors. Each table hashes a descriptor
+    by a random subset of its bits; a query probes its own bucket and the
+    buckets that differ from it in a single bit.
+    '''
+
+    def __init__(self, descriptors, offsets, tables=6, keyBits=14, seed=0):
+        descriptors = np.ascontiguousarray(descriptors, np.uint8)
+        self.train = packWords(descriptors)
+        self.offsets = np.asarray(offsets)
+        self.labels = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+        rng = np.random.RandomState(seed)
+        numBits = descriptors.shape[1] * 8
+        self.bits = np.array([rng.choice(numBits, keyBits, replace=False) for t in range(tables)])
+        self.weights = 1 << np.arange(keyBits, dtype=np.int64)
+
+        # Each table is stored as sorted keys with the descriptor order
+        self.keys = []
+        self.order = []
+        keys = self.hash(descriptors)
+        for t in range(tables):
+            order = np.argsort(keys[:, t], kind='stable')
+            self.order.append(order)
+            self.keys.append(keys[order, t])
+
+    def hash(self, descriptors):
+        '''
+        Returns the (len(descriptors), tables) array of bucket keys.
+        '''
+        bits = np.unpackbits(np.ascontiguousarray(descriptors, np.uint8), axis=1)
+        return bits[:, self.bits].astype(np.int64).dot(self.weights)
+
+    def candidates(self, query, probes):
+        '''
+        Returns (query row, train row) pairs of all descriptors that share a
+        probed bucket with a query descriptor.
+        '''
+        keys = self.hash(query)
+        flips = np.concatenate(([0], self.weights[:probes]))
+        queryRows = []
+        trainRows = []
+        for t in range(len(self.keys)):
+            probed = (keys[:, t:t+1] ^ flips[None, :]).ravel()
+            rows = np.repeat(np.arange(len(query)), len(flips))
+            lo = np.searchsorted(self.keys[t], probed, 'left')
+            hi = np.searchsorted(self.keys[t], probed, 'right')
+            counts = hi - lo
+            # positions lo..hi-1 of every probed bucket, flattened
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            queryRows.append(np.repeat(rows, counts))
+            trainRows.append(self.order[t][np.repeat(lo, counts) + within])
+
+        pairs = np.unique(np.concatenate(queryRows) * len(self.labels) + np.concatenate(trainRows))
+        return pairs // len(self.labels), pairs % len(self.labels)
+
+    def match(self, query, probes=None):
+        '''
+        Returns the number of cross-checked matches of the query in each
+        image, considering only the candidates found in the probed buckets.
+        '''
+        numImages = len(self.offsets) - 1
+        if query is None or len(query) == 0:
+            return np.zeros(numImages, int)
+        if probes is None:
+            probes = len(self.weights)
+
+        q, t = self.candidates(query, probes)
+        if len(q) == 0:
+            return np.zeros(numImages, int)
+        d = popcount(packWords(query)[q] ^ self.train[t]).sum(axis=1, dtype=np.uint16)
+        lab = self.labels[t]
+
+        # Nearest candidate of each query in each image
+        order = np.lexsort((t, d, lab, q))
+        group = (q * numImages + lab)[order]
+        rowBest = order[np.r_[True, group[1:] != group[:-1]]]
+
+        # Nearest query of each train descriptor among its candidates
+        order = np.lexsort((q, d, t))
+        first = order[np.r_[True, t[order][1:] != t[order][:-1]]]
+        colBest = np.full(len(self.labels), -1)
+        colBest[t[first]] = q[first]
+
+        mutual = rowBest[colBest[t[rowBest]] == q[rowBest]]
+        return np.bincount(lab[mutual], minlength=numImages)
+
+    def matchBatch(self, queries, probes=None):
+        '''
+        match for several queries. Candidates are looked up per query.
+        '''
+        return [self.match(query, probes) for query in queries]
@@ -0,0 +1,171 @@
+'''
+Streaming Localization
+======================
+
+Localizes the camera one frame at a time, as frames arrive on a
+robot. Localizer.step takes a single frame, given as an image array
+or a path, and the command executed before it, and returns the
+updated belief and best guess right away.
+
+The map indices are loaded once, and the only state carried between
+steps is the current belief, so memory stays constant however long
+the robot runs. The update uses the same accountCommand, prevWeight
+and probUpdate as analyzer.processRaw.
+
+Usage:
+------
+    python localizer.py -s [<directory or camera index>] -a [<algorithm>]
+'''
+
+import cv2
+import glob
+import os
+import time
+from collections import deque
+
+import belief
+from analyze import analyzer
+from prefetch import loadFrame, varianceOfLaplacian
+
+extension = '.png'
+
+
+class Step(object):
+
+    def __init__(self, belief, location, angle, blur, latency):
+        self.belief = belief
+        self.location = location
+        self.angle = angle
+        self.blur = blur
+        self.latency = latency
+
+
+class Localizer(object):
+
+    def __init__(self, method, width=800, height=600, vote=False, threads=1, dor=False, history=100, cascade=None,
+                 budget=None, grid=None, cache=None, tree=False, candidates=10, candidateMargin=None,
+                 compressed=False, pcaDims=64, subspaces=16, rerank=50, probes=8):
+        '''
+        With dor=True, only locations within 2 of the last best guess are matched,
+        as in analyzer.optP, and with dor='adaptive' the windows follow the
+        confidence of the belief, see analyzer.dorMatch. A cascade of 'Color'
+        or 'MapBOW' verifies only the candidates of that stage, chosen by
+        candidates and candidateMargin, see analyzer.createMatcher, which
+        also describes the keypoint budget, the frame cache, the tree
+        dictionaries and the compressed index. The latencies of the last history steps are kept.
+        '''
+        self.analyzer = analyzer(method, width, height, vote, threads, cascade=cascade, budget=budget, grid=grid,
+                                 cache=cache, tree=tree, candidates=candidates, candidateMargin=candidateMargin,
+                                 compressed=compressed, pcaDims=pcaDims, subspaces=subspaces, rerank=rerank,
+                                 probes=probes)
+        if method != 'BOW' and method != 'MapBOW':
+            self.analyzer.createIndex()
+        self.matcher = self.analyzer.createMatcher()
+        self.dor = dor
+        self.latencies = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        self.belief = belief.Belief.uniform(self.analyzer.numLocations, self.analyzer.numAngles)
+        self.best = None
+        self.previousBlur = 0
+        self.analyzer.expectedMatches = None
+
+    def step(self, frame, command='s'):
+        '''
+        Updates the belief with one frame, a BGR image array or an image path,
+        and the command executed since the previous frame. Returns a Step.
+        '''
+        start = time.time()
+        numLocations = self.analyzer.numLocations
+
+        if isinstance(frame, str):
+            loaded = loadFrame(frame, self.matcher.preprocess, self.analyzer.frameCache, self.matcher.preprocessKey())
+            query, blurFactor = loaded.query, loaded.blur
+        else:
+            query = self.matcher.preprocess(frame)
+            blurFactor = varianceOfLaplacian(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        self.matcher.setQueryImage(query)
+        actionAccount = self.analyzer.accountCommand(command, self.belief)
+
+        if self.dor == 'adaptive':
+            results = self.analyzer.dorMatch(self.matcher, actionAccount, self.previousBlur)[0]
+        elif self.dor and self.best is not None:
+            bestCircleIndex, bestAngleIndex = self.best
+            nearby = [i for i in range(numLocations) if abs(i - bestCircleIndex) <= 2]
+            matched = dict(zip(nearby, self.analyzer.matchLocations(self.matcher, nearby, bestAngleIndex)))
+            results = [matched.get(i, [1, [1/75] * 25]) for i in range(numLocations)]
+        else:
+            results = self.analyzer.matchLocations(self.matcher, range(numLocations))
+
+        p = belief.Belief.fromList(results)
+        adjusted = self.analyzer.prevWeight(actionAccount, p)
+        self.belief = self.analyzer.probUpdate(actionAccount, adjusted, blurFactor)
+        self.best = self.belief.best()
+        self.previousBlur = blurFactor
+
+        latency = time.time() - start
+        self.latencies.append(latency)
+        return Step(self.belief, self.best[0], self.best[1], blurFactor, latency)
+
+    def meanLatency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0
+
+
+def frameSource(source):
+    '''
+    Yields (name, frame) from a directory of images, in name order, or from
+    a cv2.VideoCapture, until it runs out of frames. Directory frames are
+    paths; capture frames are image arrays named by their count.
+    '''
+    if isinstance(source, str):
+        for imagePath in sorted(glob.glob(source + '/*' + extension)):
+            yield os.path.basename(imagePath).replace(extension, ''), imagePath
+    else:
+        count = 0
+        while True:
+            ret, frame = source.read()
+            if not ret:
+                break
+            yield str(count).zfill(4), frame
+            count += 1
+
+def localize(localizer, source, commands=None):
+    '''
+    Streams a directory or cv2.VideoCapture through the localizer, yielding
+    (name, Step) as each frame is processed. commands is a dictionary of frame
+    name to command, as read from commands.txt, or a function of the frame
+    name; frames without a command are taken as standing still.
+    '''
+    for name, frame in frameSource(source):
+        if commands is None:
+            command = 's'
+        elif callable(commands):
+            command = commands(name)
+        else:
+            command = commands.get(name, 's')
+        yield name, localizer.step(frame, command)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--source', default='cam1_img', help='Directory of frames, or index of a camera')
+    ap.add_argument('-a', '--algorithm', default='SIFT', help='Matching algorithm')
+    ap.add_argument('-c', '--commands', default='commands.txt', help='Command file of the directory')
+    ap.add_argument('--width', type=int, default=320)
+    ap.add_argument('--height', type=int, default=240)
+    args = vars(ap.parse_args())
+
+    localizer = Localizer(args['algorithm'], args['width'], args['height'])
+    source = args['source']
+    commands = None
+    if source.isdigit():
+        source = cv2.VideoCapture(int(source))
+    elif os.path.exists(args['commands']):
+        commands = localizer.analyzer.readCommand(args['commands'])
+
+    for name, step in localize(localizer, source, commands):
+        print('%s: location %d, angle %d (%.0f ms)' % (name, step.location, step.angle * 15, step.latency * 1000))
+    print('Mean latency: %.0f ms' % (localizer.meanLatency() * 1000))
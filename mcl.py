@@ -0,0 +1,200 @@
+'''
+Particle Monte Carlo Localization
+=================================
+
+A particle filter over the map grid of locations and headings.
+Each particle is a (location, heading, weight) record in one
+structured array, so prediction, weighting and resampling are
+array operations.
+
+Resampling is low-variance (systematic), and the number of
+particles is chosen by KLD-sampling: a concentrated belief that
+occupies few grid cells is represented by few particles. Since
+only the cells that particles occupy have to be scored against
+the camera frame, the matching work shrinks with the belief.
+'''
+
+import numpy as np
+
+import belief
+
+particleType = np.dtype([('location', np.int32), ('heading', np.int32), ('weight', np.float64)])
+
+
+def kldBound(k, epsilon=0.05, z=2.326):
+    '''
+    Number of particles needed so that, with probability given by the normal
+    quantile z, the KL divergence between the sample-based and the true
+    belief stays below epsilon, when the samples occupy k bins.
+    '''
+    k = np.maximum(np.asarray(k, np.float64) - 1, 1)
+    a = 2 / (9 * k)
+    return np.ceil(k / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3)
+
+def lowVarianceResample(weights, count, rng):
+    '''
+    Indices of count particles drawn in proportion to weights with a single
+    random offset, which keeps the variance of the draw low.
+    '''
+    cumulative = np.cumsum(weights)
+    positions = (rng.random() + np.arange(count)) / count * cumulative[-1]
+    return np.minimum(np.searchsorted(cumulative, positions, side='right'), len(weights) - 1)
+
+
+class ParticleFilter(object):
+
+    def __init__(self, numLocations=7, numAngles=25, minParticles=50, maxParticles=2000,
+                 epsilon=0.05, z=2.326, moveProb=0.3, turnNoise=0.1, randomFraction=0.02, seed=None):
+        self.numLocations = numLocations
+        self.numAngles = numAngles
+        self.minParticles = minParticles
+        self.maxParticles = maxParticles
+        self.epsilon = epsilon
+        self.z = z
+        self.moveProb = moveProb
+        self.turnNoise = turnNoise
+        self.randomFraction = randomFraction
+        self.rng = np.random.default_rng(seed)
+        self.particles = self.randomParticles(maxParticles)
+
+    def randomParticles(self, count):
+        particles = np.zeros(count, particleType)
+        particles['location'] = self.rng.integers(0, self.numLocations, count)
+        particles['heading'] = self.rng.integers(0, self.numAngles, count)
+        particles['weight'] = 1 / count
+        return particles
+
+    def __len__(self):
+        return len(self.particles)
+
+    def cells(self):
+        '''
+        Grid cell index of every particle.
+        '''
+        return self.particles['location'] * self.numAngles + self.particles['heading']
+
+    ####################
+    ### Motion Model ###
+    ####################
+
+    def predict(self, command):
+        '''
+        Moves the particles according to the command. 'l' and 'r' turn by one
+        heading as the grid filter does; 'f' moves a particle to the next
+        location when it faces between 0 and 180 degrees, or to the previous
+        one between 180 and 360, with probability moveProb. Headings also
+        drift by one step with probability turnNoise.
+        '''
+        location = self.particles['location']
+        heading = self.particles['heading']
+
+        if command == 'l':
+            heading -= 1
+        elif command == 'r':
+            heading += 1
+        elif command == 'f':
+            angle = heading * 15
+            moving = self.rng.random(len(self)) < self.moveProb
+            step = np.where((angle > 0) & (angle < 180), 1, np.where((angle > 180) & (angle < 360), -1, 0))
+            location += np.where(moving, step, 0)
+            np.clip(location, 0, self.numLocations - 1, out=location)
+
+        drift = self.rng.random(len(self)) < self.turnNoise
+        heading += np.where(drift, self.rng.choice([-1, 1], len(self)), 0)
+        heading %= self.numAngles
+
+    #########################
+    ### Measurement Model ###
+    #########################
+
+    def occupied(self):
+        '''
+        Dictionary of location to the sorted headings occupied by particles.
+        These are the only map images that need to be matched.
+        '''
+        cells = np.unique(self.cells())
+        locations, headings = np.divmod(cells, self.numAngles)
+        return {int(location): headings[locations == location].tolist() for location in np.unique(locations)}
+
+    def update(self, scores, blurFactor):
+        '''
+        Weighs the particles by the match scores of their cells, given as a
+        dictionary of location to {heading: score}. Scores are normalized to a
+        mean of one over the matched cells and blended with a flat likelihood
+        by the blur weight of belief.probUpdate, so blurry frames count less.
+        '''
+        table = np.zeros(self.numLocations * self.numAngles)
+        matched = np.zeros(len(table), bool)
+        for location, headingScores in scores.items():
+            for heading, score in headingScores.items():
+                table[location * self.numAngles + heading] = score
+                matched[location * self.numAngles + heading] = True
+
+        mean = table[matched].mean() if matched.any() else 0
+        if mean <= 0:
+            return
+        currentWeight = belief.blurWeight(blurFactor)
+        likelihood = (1 - currentWeight) + currentWeight * table / mean
+
+        weights = self.particles['weight'] * likelihood[self.cells()]
+        if weights.sum() > 0:
+            self.particles['weight'] = weights / weights.sum()
+
+    ##################
+    ### Resampling ###
+    ##################
+
+    def resample(self):
+        '''
+        Low-variance resampling followed by KLD-sampling: particles are kept,
+        in random order, until their count reaches the bound for the number
+        of grid cells they occupy. A small fraction is then replaced by
+        uniformly random particles so that a lost robot can recover.
+        '''
+        drawn = self.particles[lowVarianceResample(self.particles['weight'], self.maxParticles, self.rng)]
+        drawn = drawn[self.rng.permutation(len(drawn))]
+
+        cells = drawn['location'] * self.numAngles + drawn['heading']
+        first = np.zeros(len(drawn), bool)
+        first[np.unique(cells, return_index=True)[1]] = True
+        required = np.maximum(kldBound(np.cumsum(first), self.epsilon, self.z), self.minParticles)
+        enough = np.flatnonzero(np.arange(1, len(drawn) + 1) >= required)
+        count = enough[0] + 1 if len(enough) else len(drawn)
+
+        particles = drawn[:count].copy()
+        numRandom = int(round(self.randomFraction * count))
+        if numRandom:
+            particles[-numRandom:] = self.randomParticles(numRandom)
+        particles['weight'] = 1 / count
+        self.particles = particles
+
+    ##############
+    ### Output ###
+    ##############
+
+    def histogram(self):
+        '''
+        Particle weight in each grid cell, as a (locations, angles) array.
+        '''
+        mass = np.bincount(self.cells(), self.particles['weight'], self.numLocations * self.numAngles)
+        return mass.reshape(self.numLocations, self.numAngles)
+
+    def best(self):
+        '''
+        Returns (location, heading) of the grid cell holding the most weight.
+        '''
+        bestCircleIndex, bestAngleIndex = np.unravel_index(np.argmax(self.histogram()), (self.numLocations, self.numAngles))
+        return int(bestCircleIndex), int(bestAngleIndex)
+
+    def toList(self):
+        '''
+        The belief in the [[totalMatches, probL], ...] format of out.txt, with
+        the weight of each location as its total and the headings normalized
+        within it. Empty locations get flat headings.
+        '''
+        mass = self.histogram()
+        totals = mass.sum(axis=1)
+        probs = np.full(mass.shape, 1 / self.numAngles)
+        nonEmpty = totals > 0
+        probs[nonEmpty] = mass[nonEmpty] / totals[nonEmpty, None]
+        return [[total, probL] for total, probL in zip(totals.tolist(), probs.tolist())]
@@ -4,14 +4,50 @@ Panorama Creation
 
 Creates panorama given dataset of images.
 
+The resized and annotated images of a location are composed into
+one strip the first time the location is rendered, and the strip
+is kept for the rest of the process. A render copies the strip and
+draws the rectangle of the matched angle on it, so writing the
+panorama of every frame of a run only reads each location once.
+
 Usage:
 ------
     python pano.py -d [<image folder>]
+
+    python pano.py -b [<best guess file>] -o [<output folder>]
+
+    The second form writes the panorama of the best guess of every
+    frame of a run, e.g. of bestGuess.bin.
 '''
 
 import cv2
-import numpy as np 
+import numpy as np
 import argparse
+import functools
+import os
+
+import probStore
+
+ANGLES = range(0, 375, 15)
+
+
+@functools.lru_cache(maxsize=None)
+def loadStrip(dataset, height, width):
+    '''
+    The resized, annotated images of a location side by side, read once
+    per process. The strip is read-only; renders draw on copies of it.
+    '''
+    strip = np.zeros((height, width*len(ANGLES), 3), np.uint8)
+    for x, angle in enumerate(ANGLES):
+        currentImg = cv2.imread('%s/angle%s.jpg' % (dataset, str(angle).zfill(3)))
+        if currentImg is None:
+            raise IOError('Cannot read %s/angle%s.jpg' % (dataset, str(angle).zfill(3)))
+        smallImg = cv2.resize(currentImg, (width, height))
+        cv2.putText(smallImg, str(angle), (int(0.55*width), height-10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
+        cv2.line(smallImg, (int(width*0.5), 0), (int(width*0.5), height), (255, 0, 0), 1)
+        strip[:, x*width:(x+1)*width] = smallImg
+    strip.setflags(write=False)
+    return strip
 
 class Panorama(object):
 
@@ -20,6 +56,7 @@ class Panorama(object):
         self.h = height
         self.w = width
         self.match = matchAngle
+        self.strip = loadStrip(data, height, width)
         self.images = self.readImages()
 
     def copyTo(self, arr1, arr2, y, x):
@@ -30,54 +67,73 @@ class Panorama(object):
         if y + arr2.shape[0] > arr1.shape[0] or x + arr2.shape[1] > arr1.shape[1]:
             raise ValueError('Dimensions of image are exceeded.')
 
-        for i in range(arr2.shape[0]):
-            for j in range(arr2.shape[1]):
-                arr1[y+i][j+x] = arr2[i][j]
+        arr1[y:y+arr2.shape[0], x:x+arr2.shape[1]] = arr2
 
     def readImages(self):
         '''
         Read images from dataset. Images must be named as 'angle[<measure>].jpg', e.g.
-        'angle225.jpg'. 
+        'angle225.jpg'. The images are views of the cached strip.
         '''
-        imgArr = []
-        for angle in range(0, 375, 15):
-            currentImg = cv2.imread('%s/angle%s.jpg' % (self.dataset, str(angle).zfill(3)))
-            smallImg = cv2.resize(currentImg, (self.w, self.h))
-            cv2.putText(smallImg, str(angle), (int(0.55*self.w), self.h-10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
-            cv2.line(smallImg, (int(self.w*0.5), 0), (int(self.w*0.5), self.h), (255, 0, 0), 1)
-            imgArr.append(smallImg)
-        return imgArr
-
-    def drawRect(self, image):
-        pt1 = (int(self.match/360 * self.w * 24), 0)
-        pt2 = (int(self.match/360 * self.w * 24 + self.w), self.h)
+        return [self.strip[:, x*self.w:(x+1)*self.w] for x in range(len(ANGLES))]
+
+    def drawRect(self, image, match=None):
+        match = self.match if match is None else match
+        pt1 = (int(match/360 * self.w * 24), 0)
+        pt2 = (int(match/360 * self.w * 24 + self.w), self.h)
         cv2.rectangle(image, pt1, pt2, (0, 0, 255), 5)
 
-    def write(self, filename):
-        img = np.zeros((self.h, self.w*len(self.images), 3), np.uint8)
-        for x in range(len(self.images)):
-            try:
-                self.copyTo(img, self.images[x], 0, x*self.w)
-            except:
-                pass
-        self.drawRect(img)
-        cv2.imwrite(filename, img   )
+    def render(self, match=None):
+        '''
+        The panorama with the rectangle of the matched angle, by default the
+        one given to the constructor.
+        '''
+        img = self.strip.copy()
+        self.drawRect(img, match)
+        return img
+
+    def write(self, filename, match=None):
+        cv2.imwrite(filename, self.render(match))
 
     def run(self):
-        img = np.zeros((self.h, self.w*len(self.images), 3), np.uint8)
-        for x in range(len(self.images)):
-            try:
-                self.copyTo(img, self.images[x], 0, x*self.w)
-            except:
-                pass
-        self.drawRect(img)
-        cv2.imshow('Panorama', img)
+        cv2.imshow('Panorama', self.render())
         cv2.waitKey(0)
 
+def renderRun(bestGuess, root='map', height=100, width=100):
+    '''
+    Panoramas of a whole run, one frame at a time. bestGuess is a
+    (frames, 2) array of (location, angle index) as written to
+    bestGuess.bin; location i is read from root/i. Yields (frame,
+    panorama) in frame order, each panorama a fresh copy of the cached
+    strip of its location; np.stack gives one array of the whole run.
+    '''
+    for frame, (location, angleIndex) in enumerate(np.asarray(bestGuess, int).reshape(-1, 2).tolist()):
+        yield frame, Panorama('%s/%d' % (root, location), height, width, angleIndex * 15).render()
+
+def writeRun(bestGuess, folder, root='map', height=100, width=100):
+    '''
+    Writes the panorama of every frame of a run to folder/<frame>.jpg,
+    frames numbered as in bestGuess. Only one panorama is held at a time.
+    '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for frame, panorama in renderRun(bestGuess, root, height, width):
+        cv2.imwrite('%s/%s.jpg' % (folder, str(frame).zfill(4)), panorama)
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
-    ap.add_argument('-d', '--dataset', required=True,
+    ap.add_argument('-d', '--dataset',
         help='Path to the directory containing images')
+    ap.add_argument('-b', '--bestGuess',
+        help='Path to the best guesses of a run, e.g. bestGuess.bin')
+    ap.add_argument('-o', '--output', default='panoramas',
+        help='Folder the panoramas of a run are written to')
+    ap.add_argument('-m', '--map', default='map',
+        help='Folder containing one image folder per location')
     args = vars(ap.parse_args())
 
-    Panorama(args['dataset'], 100, 100, 210).run()
\ No newline at end of file
+    if args['bestGuess'] is not None:
+        writeRun(probStore.readFrames(args['bestGuess']).reshape(-1, 2), args['output'], args['map'])
+    elif args['dataset'] is not None:
+        Panorama(args['dataset'], 100, 100, 210).run()
+    else:
+        ap.error('one of -d or -b is required')
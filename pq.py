@@ -0,0 +1,317 @@
+'''
+Compressed Descriptors
+======================
+
+PCA and product quantization of float descriptors such as SIFT
+and SURF, for maps too large to keep their raw descriptors in
+memory.
+
+Descriptors are centred and projected on their leading principal
+components, the projection is split into subspaces, and each
+subspace is replaced by the index of its nearest centroid. With the
+defaults a 128-dimensional float32 SIFT descriptor (512 bytes)
+becomes 16 one-byte codes, plus the float16 energy that the
+projection drops.
+
+Queries are compared to the codes by asymmetric distance computation
+(ADC): the query is not quantized, its squared distances to every
+centroid of every subspace are tabulated once, and its distance to a
+code is the sum of the table entries the code selects. Summing over
+all codes of a location is one sparse matrix product.
+
+The raw descriptors can stay on disk, memory-mapped, to re-rank the
+short list of every query by exact distances.
+
+Usage:
+------
+    python pq.py -a [<algorithm>] -p [<dimensions>] -s [<subspaces>] -r [<short list>] -n [<probes>]
+
+    Reports the memory of every location's index and the vote match
+    counts of the cam1_img frames, exact and compressed.
+'''
+
+import os
+import numpy as np
+import scipy.sparse
+
+
+def squaredDistances(data, centroids):
+    '''
+    (data, centroids) squared Euclidean distances.
+    '''
+    dists = (data**2).sum(axis=1)[:, None] - 2 * data @ centroids.T + (centroids**2).sum(axis=1)[None]
+    return np.maximum(dists, 0)
+
+def kmeans(data, k, iterations=20, rng=None):
+    '''
+    Lloyd's k-means from k distinct random points of data. Returns the
+    (k, dims) centroids; a centroid that loses all its points stays put.
+    '''
+    rng = rng or np.random.RandomState(0)
+    data = np.asarray(data, np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for i in range(iterations):
+        # the squared norms of the points do not change the nearest centroid
+        labels = ((centroids**2).sum(axis=1)[None] - 2 * data @ centroids.T).argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, data[:, d], minlength=k) for d in range(data.shape[1])], axis=1)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class ProductQuantizer(object):
+
+    def __init__(self, mean, components, centroids):
+        '''
+        mean and the (dims, descriptor length) components are the PCA
+        projection; centroids is the (subspaces, 2**bits, dims // subspaces)
+        array of codebooks.
+        '''
+        self.mean = mean
+        self.components = components
+        self.centroids = centroids
+        self.subspaces, self.numCentroids, self.subDims = centroids.shape
+
+    @classmethod
+    def train(cls, descriptors, dims=64, subspaces=16, bits=8, sample=20000, seed=0):
+        '''
+        Fits the projection and codebooks to (a random sample of) descriptors.
+        '''
+        descriptors = np.asarray(descriptors, np.float32)
+        dims = min(dims, descriptors.shape[1])
+        if dims % subspaces:
+            raise ValueError('%d dimensions do not split into %d subspaces' % (dims, subspaces))
+        rng = np.random.RandomState(seed)
+        if len(descriptors) > sample:
+            descriptors = descriptors[np.sort(rng.choice(len(descriptors), sample, replace=False))]
+
+        # principal components, largest first
+        mean = descriptors.mean(axis=0)
+        values, vectors = np.linalg.eigh(np.cov(descriptors - mean, rowvar=False))
+        components = np.ascontiguousarray(vectors[:, ::-1][:, :dims].T, np.float32)
+        projected = (descriptors - mean) @ components.T
+
+        subDims = dims // subspaces
+        k = min(2**bits, len(descriptors))
+        centroids = np.zeros((subspaces, 2**bits, subDims), np.float32)
+        for m in range(subspaces):
+            centroids[m, :k] = kmeans(projected[:, m*subDims:(m+1)*subDims], k, rng=rng)
+        return cls(mean, components, centroids)
+
+    def project(self, descriptors):
+        '''
+        Returns the PCA projections and the squared norms left out by them.
+        '''
+        centred = np.asarray(descriptors, np.float32) - self.mean
+        projected = centred @ self.components.T
+        dropped = np.maximum((centred**2).sum(axis=1) - (projected**2).sum(axis=1), 0)
+        return projected, dropped
+
+    def subspaceDistances(self, projected):
+        '''
+        (subspaces, centroids, descriptors) squared distances of projected
+        descriptors to every centroid.
+        '''
+        split = np.ascontiguousarray(projected.reshape(len(projected), self.subspaces, self.subDims).transpose(1, 2, 0))
+        dists = np.matmul(self.centroids, split)
+        dists *= -2
+        dists += (split**2).sum(axis=1)[:, None, :]
+        dists += (self.centroids**2).sum(axis=2)[:, :, None]
+        return np.maximum(dists, 0, out=dists)
+
+    def encode(self, descriptors, chunk=65536):
+        '''
+        Returns the (descriptors, subspaces) uint8 codes and the float16
+        squared norms dropped by the projection.
+        '''
+        codes = np.zeros((len(descriptors), self.subspaces), np.uint8)
+        dropped = np.zeros(len(descriptors), np.float16)
+        for start in range(0, len(descriptors), chunk):
+            projected, dropped[start:start+chunk] = self.project(descriptors[start:start+chunk])
+            codes[start:start+chunk] = self.subspaceDistances(projected).argmin(axis=1).T
+        return codes, dropped
+
+    def tables(self, query):
+        '''
+        ADC lookup tables of query descriptors, flattened to (subspaces *
+        centroids, queries), and the squared norms their projections drop.
+        '''
+        projected, dropped = self.project(query)
+        return self.subspaceDistances(projected).reshape(-1, len(query)), dropped
+
+
+class CompressedIndex(object):
+
+    def __init__(self, quantizer, coarse, listOffsets, ids, codes, dropped, descriptors=None):
+        '''
+        The codes are grouped by their nearest coarse centroid in projection
+        space: the codes of list l are codes[listOffsets[l]:listOffsets[l+1]],
+        and ids gives the descriptor row of every code. descriptors, if given,
+        are the raw descriptors, normally memory-mapped, used only to re-rank.
+        '''
+        self.quantizer = quantizer
+        self.coarse = coarse
+        self.listOffsets = listOffsets
+        self.ids = ids
+        self.codes = codes
+        self.dropped = dropped
+        self.descriptors = descriptors
+
+    @classmethod
+    def build(cls, descriptors, dims=64, subspaces=16, bits=8, lists=128, seed=0):
+        quantizer = ProductQuantizer.train(descriptors, dims, subspaces, bits, seed=seed)
+        codes, dropped = quantizer.encode(descriptors)
+
+        # inverted file over a coarse clustering of the projections
+        sample = descriptors[np.sort(np.random.RandomState(seed).choice(len(descriptors),
+                                                                        min(len(descriptors), 20000), replace=False))]
+        lists = min(lists, len(descriptors))
+        coarse = kmeans(quantizer.project(sample)[0], lists, rng=np.random.RandomState(seed))
+        assignment = np.concatenate([squaredDistances(quantizer.project(descriptors[i:i+65536])[0], coarse).argmin(axis=1)
+                                     for i in range(0, len(descriptors), 65536)])
+        ids = np.argsort(assignment, kind='stable').astype(np.int32)
+        listOffsets = np.zeros(lists + 1, np.int64)
+        listOffsets[1:] = np.cumsum(np.bincount(assignment, minlength=lists))
+        return cls(quantizer, coarse, listOffsets, ids, codes[ids], dropped[ids], descriptors)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        '''
+        Memory held by the index, excluding the raw descriptors on disk.
+        '''
+        q = self.quantizer
+        return sum(array.nbytes for array in (self.codes, self.dropped, self.ids, self.listOffsets, self.coarse,
+                                              q.mean, q.components, q.centroids))
+
+    def save(self, path):
+        '''
+        Writes the index under a temporary name first, so that other
+        processes never load part of it.
+        '''
+        q = self.quantizer
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as file:
+            np.savez(file, mean=q.mean, components=q.components, centroids=q.centroids, coarse=self.coarse,
+                     listOffsets=self.listOffsets, ids=self.ids, codes=self.codes, dropped=self.dropped)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, descriptors=None):
+        stored = np.load(path)
+        quantizer = ProductQuantizer(stored['mean'], stored['components'], stored['centroids'])
+        return cls(quantizer, stored['coarse'], stored['listOffsets'], stored['ids'], stored['codes'],
+                   stored['dropped'], descriptors)
+
+    def onehot(self, start, end):
+        '''
+        (codes, subspaces * centroids + 1) sparse matrix selecting the table
+        entry of every subspace of the codes from start to end, and their
+        dropped norms from a last row of ones, so that their ADC distances
+        are a product with the lookup tables. It is built for each list as
+        it is searched, being several times larger than the codes.
+        '''
+        codes = self.codes[start:end]
+        n, m = codes.shape
+        width = m * self.quantizer.numCentroids
+        indices = np.empty((n, m + 1), np.int32)
+        indices[:, :m] = codes + np.arange(m, dtype=np.int32) * self.quantizer.numCentroids
+        indices[:, m] = width
+        data = np.ones((n, m + 1), np.float32)
+        data[:, m] = self.dropped[start:end]
+        return scipy.sparse.csr_matrix((data.ravel(), indices.ravel(), np.arange(0, n * (m + 1) + 1, m + 1)),
+                                       shape=(n, width + 1))
+
+    def search(self, query, k, rerank=0, probes=8):
+        '''
+        Returns the (queries, k) descriptor rows and squared distances of the
+        nearest codes to each query descriptor, like a FLANN knnSearch. Only
+        the probes lists nearest to a query are scanned. Distances are ADC
+        estimates; with rerank > k and the raw descriptors available, the
+        rerank nearest by ADC are re-ordered by their exact distances.
+        '''
+        query = np.asarray(query, np.float32)
+        k = min(k, len(self))
+        shortList = max(k, rerank) if self.descriptors is not None else k
+        probes = min(probes, len(self.coarse))
+        tables, dropped = self.quantizer.tables(query)
+        tables = np.vstack((tables, np.ones((1, len(query)), np.float32)))
+
+        # the short list of each query, gathered list by list
+        probed = np.argsort(squaredDistances(self.quantizer.project(query)[0], self.coarse), axis=1)[:, :probes]
+        candidates = np.zeros((len(query), probes, shortList), np.int64)
+        estimates = np.full((len(query), probes, shortList), np.inf, np.float32)
+        for l in np.unique(probed):
+            rows, slots = np.nonzero(probed == l)
+            start, end = self.listOffsets[l], self.listOffsets[l+1]
+            if end == start:
+                continue
+            block = (self.onehot(start, end) @ tables[:, rows]).T
+            n = min(shortList, end - start)
+            if n < end - start:
+                nearest = np.argpartition(block, n - 1, axis=1)[:, :n]
+            else:
+                nearest = np.broadcast_to(np.arange(n), (len(rows), n))
+            candidates[rows, slots, :n] = start + nearest
+            estimates[rows, slots, :n] = np.take_along_axis(block, nearest, axis=1)
+
+        candidates = candidates.reshape(len(query), -1)
+        estimates = estimates.reshape(len(query), -1)
+        short = np.argsort(estimates, axis=1, kind='stable')[:, :shortList]
+        candidates = np.take_along_axis(candidates, short, axis=1)
+        dists = np.take_along_axis(estimates, short, axis=1) + dropped[:, None]
+        if shortList > k:
+            ids = self.ids[candidates]
+            rows = np.unique(ids)
+            exact = np.asarray(self.descriptors[rows], np.float32)[np.searchsorted(rows, ids)]
+            dists = np.where(np.isfinite(dists), ((exact - query[:, None, :])**2).sum(axis=2), np.inf)
+            order = np.argsort(dists, axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            dists = np.take_along_axis(dists, order, axis=1)
+        return self.ids[candidates[:, :k]].astype(np.int64), dists[:, :k]
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+    from Matcher import Matcher
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-a', '--algorithm', default='SIFT', help='Feature algorithm: SIFT or SURF')
+    ap.add_argument('-p', '--dims', type=int, default=64, help='PCA dimensions')
+    ap.add_argument('-s', '--subspaces', type=int, default=16, help='Product quantization subspaces')
+    ap.add_argument('-r', '--rerank', type=int, default=50, help='Short list re-ranked by exact distances')
+    ap.add_argument('-n', '--probes', type=int, default=8, help='Inverted lists scanned per query descriptor')
+    ap.add_argument('--width', type=int, default=320)
+    ap.add_argument('--height', type=int, default=240)
+    args = vars(ap.parse_args())
+
+    exact = Matcher(args['algorithm'], width=args['width'], height=args['height'], vote=True)
+    compressed = Matcher(args['algorithm'], width=args['width'], height=args['height'], vote=True, compressed=True,
+                         pcaDims=args['dims'], subspaces=args['subspaces'], rerank=args['rerank'],
+                         probes=args['probes'])
+    queries = sorted(glob.glob('cam1_img/*.png'))
+
+    print('%10s %12s %12s %8s %12s %12s' % ('location', 'raw MB', 'pq MB', 'ratio', 'exact votes', 'pq votes'))
+    for location in sorted(mapp[:-1] for mapp in glob.glob('map/*/')):
+        exact.setDirectory(location)
+        index = exact.createFeatureIndex()
+        exact.setIndex(index)
+        compressed.setDirectory(location)
+        compressed.setIndex(index)
+        imagePaths = index.keys()
+
+        raw = index.descriptors.nbytes
+        packed = index.compressedIndex(compressed.pcaDims, compressed.subspaces).nbytes
+        exactVotes, pqVotes = 0, 0
+        for query in queries:
+            exact.setQuery(query)
+            compressed.setQueryImage(exact.image)
+            compressed.queryFeatures = exact.getQueryFeatures()
+            exactVotes += sum(exact.voteMatch(imagePaths))
+            pqVotes += sum(compressed.voteMatch(imagePaths))
+        print('%10s %12.2f %12.2f %8.1f %12d %12d' % (location, raw / 1e6, packed / 1e6, raw / float(packed),
+                                                      exactVotes, pqVotes))
@@ -0,0 +1,111 @@
+'''
+Frame Prefetching
+=================
+
+Decodes and preprocesses upcoming camera frames on background
+threads while the current frame is being matched. Each frame file
+is read from disk once, and its preprocessed query image and blur
+factor are handed to every consumer.
+
+At most `depth` frames are in flight at a time, which bounds the
+memory held by the pipeline.
+
+With a frameCache.FrameCache, the blur factor and the preprocessed
+query of a frame are computed once and read back on later runs.
+'''
+
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import frameCache
+
+
+def varianceOfLaplacian(gray):
+    '''
+    The blurriness factor of a grayscale image.
+    '''
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+class Frame(object):
+
+    def __init__(self, path, query, blur):
+        self.path = path
+        self.query = query
+        self.blur = blur
+
+
+def loadFrame(imagePath, preprocess=None, cache=None, preprocessKey=None):
+    '''
+    Reads a frame file once. The color image is passed through preprocess,
+    if given, to become the query; the blur factor is computed from the
+    grayscale decoding of the same bytes, as with cv2.imread(imagePath, 0).
+    With a cache, both are looked up by the content of the file first; the
+    query is only cached if preprocessKey describes the preprocessing.
+    '''
+    return decodeFrame(np.fromfile(imagePath, np.uint8), preprocess, imagePath, cache, preprocessKey)
+
+def decodeFrame(data, preprocess=None, path=None, cache=None, preprocessKey=None):
+    '''
+    loadFrame for the encoded bytes of an image file already in memory.
+    '''
+    data = np.frombuffer(data, np.uint8)
+    if cache is None:
+        query = None
+        if preprocess is not None:
+            query = preprocess(cv2.imdecode(data, cv2.IMREAD_COLOR))
+        return Frame(path, query, varianceOfLaplacian(cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)))
+
+    source = frameCache.digest(data)
+    key = cache.key(source, 'blur')
+    stored = cache.get(key)
+    if stored is None:
+        blur = varianceOfLaplacian(cv2.imdecode(data, cv2.IMREAD_GRAYSCALE))
+        cache.put(key, blur=np.float64(blur))
+    else:
+        blur = float(stored['blur'])
+
+    query = None
+    if preprocess is not None and preprocessKey is None:
+        query = preprocess(cv2.imdecode(data, cv2.IMREAD_COLOR))
+    elif preprocess is not None:
+        key = cache.key(source, 'query', preprocessKey)
+        stored = cache.get(key)
+        if stored is None:
+            query = preprocess(cv2.imdecode(data, cv2.IMREAD_COLOR))
+            cache.put(key, png=cv2.imencode('.png', query)[1])
+        else:
+            query = cv2.imdecode(stored['png'], cv2.IMREAD_UNCHANGED)
+    return Frame(path, query, blur)
+
+
+class FramePrefetcher(object):
+    '''
+    Iterates over Frames in the order of imagePaths, loading up to depth
+    frames ahead on a pool of background threads. OpenCV releases the GIL
+    while decoding and filtering, so loading overlaps with matching.
+    '''
+
+    def __init__(self, imagePaths, preprocess=None, depth=4, workers=2, cache=None, preprocessKey=None):
+        self.imagePaths = list(imagePaths)
+        self.preprocess = preprocess
+        self.depth = max(1, depth)
+        self.workers = workers
+        self.cache = cache
+        self.preprocessKey = preprocessKey
+
+    def __iter__(self):
+        pending = []
+        executor = ThreadPoolExecutor(self.workers)
+        try:
+            for imagePath in self.imagePaths:
+                pending.append(executor.submit(loadFrame, imagePath, self.preprocess, self.cache, self.preprocessKey))
+                if len(pending) >= self.depth:
+                    yield pending.pop(0).result()
+            while pending:
+                yield pending.pop(0).result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,142 @@
+'''
+Probability Storage
+===================
+
+Binary, append-only storage for per-frame results such as the
+raw and filtered probabilities (rawP.bin, out.bin) and the best
+guesses (bestGuess.bin).
+
+A file is a short text header describing the dtype and the shape
+of one frame, e.g. (locations, 1 + angles), followed by the frames
+as raw bytes. Frames are appended as they are processed, and the
+whole run is read back as a memory-mapped (frames, ...) array.
+A frame cut off by an interrupted write is ignored.
+
+Usage:
+------
+    python probStore.py -i [<text file>] -o [<binary file>] -n [<locations>]
+
+    Converts a rawP.txt or out.txt file from the old text format.
+'''
+
+import ast
+import os
+import numpy as np
+
+magic = b'\x93PROBS'
+alignment = 64
+
+
+def writeHeader(path, frameShape, dtype):
+    header = repr({'descr': np.dtype(dtype).str, 'shape': tuple(int(n) for n in frameShape)}).encode('ascii')
+    length = len(magic) + 2 + len(header) + 1
+    header += b' ' * (-length % alignment) + b'\n'
+    with open(path, 'wb') as file:
+        file.write(magic + np.uint16(len(header)).tobytes() + header)
+
+def readHeader(path):
+    '''
+    Returns the dtype, frame shape and data offset of a file.
+    '''
+    with open(path, 'rb') as file:
+        if file.read(len(magic)) != magic:
+            raise ValueError('%s is not a probability file' % path)
+        length = int(np.frombuffer(file.read(2), np.uint16)[0])
+        header = ast.literal_eval(file.read(length).decode('ascii').strip())
+    return np.dtype(header['descr']), tuple(header['shape']), len(magic) + 2 + length
+
+
+class FrameStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.dtype, self.frameShape, self.offset = readHeader(path)
+        self.frameSize = self.dtype.itemsize * int(np.prod(self.frameShape))
+
+    @classmethod
+    def create(cls, path, frameShape, dtype=np.float64):
+        '''
+        Creates an empty file, replacing any existing one.
+        '''
+        writeHeader(path, frameShape, dtype)
+        return cls(path)
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - self.offset) // self.frameSize
+
+    def append(self, frames):
+        '''
+        Appends one frame or a (frames, ...) array of them.
+        '''
+        frames = np.ascontiguousarray(frames, self.dtype)
+        if frames.shape == self.frameShape:
+            frames = frames[None]
+        if frames.shape[1:] != self.frameShape:
+            raise ValueError('frames of shape %s do not fit %s' % (frames.shape[1:], self.path))
+
+        with open(self.path, 'r+b') as file:
+            # Overwrite a partial frame left by an interrupted write
+            file.seek(self.offset + len(self) * self.frameSize)
+            file.write(frames.tobytes())
+            file.truncate()
+
+    def load(self):
+        '''
+        All complete frames, memory-mapped read-only.
+        '''
+        count = len(self)
+        if count == 0:
+            return np.zeros((0,) + self.frameShape, self.dtype)
+        return np.memmap(self.path, self.dtype, 'r', self.offset, (count,) + self.frameShape)
+
+
+def writeFrames(path, frames, mode='a', dtype=np.float64):
+    '''
+    Appends frames to a file, creating it first if mode is 'w' or the file
+    does not exist.
+    '''
+    frames = np.asarray(frames)
+    if mode == 'w' or not os.path.exists(path):
+        FrameStore.create(path, frames.shape[1:], dtype)
+    FrameStore(path).append(frames)
+
+def readFrames(path):
+    return FrameStore(path).load()
+
+def circleArray(circles):
+    '''
+    Converts [[totalMatches, probL], ...] into a (circles, 1 + angles) array.
+    '''
+    return np.array([[circle[0]] + list(circle[1]) for circle in circles], np.float64)
+
+def circleList(frame):
+    '''
+    Converts a (circles, 1 + angles) array back into [[totalMatches, probL], ...].
+    '''
+    return [[row[0], row[1:]] for row in np.asarray(frame).tolist()]
+
+def readText(filename, numLocations):
+    '''
+    Reads a probability file in the old text format, with a line of total
+    matches and a line of probabilities per location, into a (frames,
+    locations, 1 + angles) array.
+    '''
+    lines = open(filename, 'r').read().split('\n')[:-1]
+    rows = []
+    for i in range(0, len(lines) - 1, 2):
+        probL = lines[i+1].replace('np.float64(', '').replace(')', '').strip('[]').split(',')
+        rows.append([float(lines[i].replace('np.float64(', '').replace(')', ''))] + list(map(float, probL)))
+    return np.array(rows).reshape(-1, numLocations, len(rows[0]))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', required=True, help='Text file to convert')
+    ap.add_argument('-o', '--output', required=True, help='Binary file to write')
+    ap.add_argument('-n', '--locations', type=int, default=7, help='Number of locations')
+    args = vars(ap.parse_args())
+
+    writeFrames(args['output'], readText(args['input'], args['locations']), 'w')
+    print('Wrote %d frames to %s' % (len(readFrames(args['output'])), args['output']))
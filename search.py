@@ -1,22 +1,92 @@
 import numpy as np
+import glob
+import os
 
-class Searcher(object):
-    def __init__(self, index):
-        self.index = index
+extension = '.png'
+
+
+class ColorIndex(object):
+    '''
+    Color histograms of the images in a location, stored as one
+    (images, bins) float32 matrix with the image names alongside.
+    The matrix is saved under index/Color/ and only recomputed when
+    an image of the location changes.
+    '''
+
+    def __init__(self, data, root='index'):
+        self.data = data
+        self.path = os.path.join(root, 'Color', data.strip('/').replace('/', '_') + '.npz')
+        self.names = np.zeros(0, str)
+        self.features = np.zeros((0, 0), np.float32)
+
+    def signature(self, imagePaths):
+        stats = [os.stat(imagePath) for imagePath in imagePaths]
+        return np.array([[stat.st_size, stat.st_mtime] for stat in stats], np.float64).reshape(-1, 2)
 
-    def search(self, queryFeatures):
-        results = {}
+    def update(self, createHistogram, read):
+        '''
+        Loads the saved histograms if the images are unchanged, otherwise
+        computes them with createHistogram(read(imagePath)) and saves them.
+        '''
+        imagePaths = sorted(glob.glob(self.data + '/*' + extension))
+        names = np.array([os.path.basename(imagePath) for imagePath in imagePaths])
+        signature = self.signature(imagePaths)
 
-        for (k, features) in self.index.items():
-            d = self.chisquared(features, queryFeatures)
-            results[k] = d
+        if os.path.exists(self.path):
+            saved = np.load(self.path)
+            if np.array_equal(saved['names'], names) and np.array_equal(saved['signature'], signature):
+                self.names = saved['names']
+                self.features = saved['features']
+                return self
+
+        self.names = names
+        self.features = np.array([createHistogram(read(imagePath)) for imagePath in imagePaths], np.float32)
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        np.savez(self.path, names=self.names, features=self.features, signature=signature)
+        return self
+
+
+class Searcher(object):
+    def __init__(self, index):
+        '''
+        The index is either a ColorIndex or a dictionary of image names
+        and histograms.
+        '''
+        if isinstance(index, dict):
+            self.names = np.array(sorted(index.keys()))
+            self.features = np.array([index[k] for k in self.names], np.float32)
+        else:
+            self.names = index.names
+            self.features = index.features
 
-        results = sorted([(v,k) for (k,v) in results.items()])
+    def search(self, queryFeatures, k=None):
+        '''
+        Returns (chi-squared distance, image name) for the k closest images,
+        or for every image, sorted by distance.
+        '''
+        distances, indices = self.searchBatch(np.asarray(queryFeatures)[None, :], k)
+        return [(d, self.names[i]) for d, i in zip(distances[0], indices[0])]
 
-        return results
+    def searchBatch(self, queryFeatures, k=None):
+        '''
+        Searches a (queries, bins) batch of histograms at once. Returns the
+        distances and image indices of the k closest images of each query,
+        sorted by distance.
+        '''
+        d = self.chisquared(self.features[None, :, :], np.asarray(queryFeatures, np.float32)[:, None, :])
+        if k is None or k >= d.shape[1]:
+            indices = np.argsort(d, axis=1, kind='stable')
+        else:
+            indices = np.argpartition(d, k-1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(d, indices, axis=1), axis=1, kind='stable')
+            indices = np.take_along_axis(indices, order, axis=1)
+        return np.take_along_axis(d, indices, axis=1), indices
 
     def chisquared(self, histA, histB, eps=1e-10):
-        d = 0.5 * np.sum([((a - b) ** 2) / (a + b + eps)
-            for (a, b) in zip(histA, histB)])
+        '''
+        Chi-squared distance over the last axis, broadcasting the others.
+        '''
+        d = 0.5 * np.sum(((histA - histB) ** 2) / (histA + histB + eps), axis=-1)
 
-        return d
\ No newline at end of file
+        return d
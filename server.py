@@ -0,0 +1,336 @@
+'''
+Localization Server
+===================
+
+Serves localization to several robots from one process that holds
+the map indices once. Robots send encoded frames and their commands
+over a TCP or Unix socket, tagged with a session id, and the server
+keeps a separate belief for every session.
+
+Requests that arrive within a short batching window of each other are
+handled as one batch: their features are extracted concurrently, and
+the descriptors of all frames in the batch are searched together, with
+one search per map image, or in vote mode one FLANN query per location
+(see Matcher.matchImagesBatch).
+
+Every message is a 4-byte big-endian length followed by a JSON header;
+a request header gives the byte length of the encoded image that
+follows it:
+
+    request     {"session": "robot1", "command": "l", "size": 23142}
+    response    {"session": "robot1", "location": 3, "angle": 7, ...}
+
+Usage:
+------
+    python server.py serve -a [<algorithm>] -p [<port>] [-v]
+    python server.py load -p [<port>] -r [<robots>] -n [<frames>]
+
+    The load generator replays cam1_img from several concurrent robots
+    and reports throughput and latency percentiles.
+'''
+
+import asyncio
+import glob
+import json
+import struct
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import belief
+from analyze import analyzer
+from prefetch import decodeFrame
+
+extension = '.png'
+
+
+async def readMessage(reader):
+    '''
+    Returns the JSON header of the next message, or None at the end of the stream.
+    '''
+    try:
+        size = struct.unpack('>I', await reader.readexactly(4))[0]
+        return json.loads((await reader.readexactly(size)).decode('utf-8'))
+    except asyncio.IncompleteReadError:
+        return None
+
+def writeMessage(writer, header):
+    data = json.dumps(header).encode('utf-8')
+    writer.write(struct.pack('>I', len(data)) + data)
+
+
+class Session(object):
+
+    def __init__(self, numLocations, numAngles):
+        self.belief = belief.Belief.uniform(numLocations, numAngles)
+        self.lastSeen = time.time()
+
+
+class Request(object):
+
+    def __init__(self, session, command, data, future, reset=False):
+        self.session = session
+        self.command = command
+        self.data = data
+        self.future = future
+        self.reset = reset
+        self.received = time.time()
+
+
+class LocalizationServer(object):
+
+    def __init__(self, method, width=320, height=240, vote=False, window=0.01, maxBatch=16,
+                 threads=4, sessionTimeout=600, budget=None, grid=None, tree=False, cascade=None, candidates=10,
+                 candidateMargin=None, compressed=False, pcaDims=64, subspaces=16, rerank=50, probes=8):
+        '''
+        Requests are collected for up to window seconds, or until maxBatch of
+        them are waiting, before a batch is matched. Features are extracted on
+        threads worker threads. Sessions idle for sessionTimeout seconds are
+        dropped. As with Localizer, frames are matched image by image unless
+        vote is set, in which case they vote through the FLANN index of each
+        location; either way the descriptors of a batch are searched together.
+        budget and grid are the keypoint budget of the map and the frames,
+        see featureIndex.selectKeypoints. With tree set, BOW matches against
+        the vocabulary tree dictionaries. A cascade verifies only the
+        candidates of its cheap stage, as in analyzer.createMatcher; each
+        request then has its own candidates and is matched on its own. With
+        vote and compressed set, votes are searched in the compressed index
+        of each location, see analyzer.createMatcher.
+        '''
+        self.analyzer = analyzer(method, width, height, vote, budget=budget, grid=grid, tree=tree, cascade=cascade,
+                                 candidates=candidates, candidateMargin=candidateMargin, compressed=compressed,
+                                 pcaDims=pcaDims, subspaces=subspaces, rerank=rerank, probes=probes)
+        if method != 'BOW' and method != 'MapBOW':
+            self.analyzer.createIndex()
+        self.method = method
+        self.w = width
+        self.h = height
+        self.window = window
+        self.maxBatch = maxBatch
+        self.sessionTimeout = sessionTimeout
+        self.sessions = {}
+        self.sessionsLock = threading.Lock()
+        self.executor = ThreadPoolExecutor(threads)
+        self.local = threading.local()
+        self.queue = None
+
+    def matcher(self):
+        '''
+        A Matcher of the calling thread, since OpenCV detectors are not
+        shared between threads.
+        '''
+        if not hasattr(self.local, 'matcher'):
+            self.local.matcher = self.analyzer.createMatcher()
+        return self.local.matcher
+
+    ################
+    ### Matching ###
+    ################
+
+    def prepareFrame(self, data):
+        '''
+        Decodes a frame and extracts its features on a worker thread.
+        Returns the blur factor and a Matcher holding the prepared query.
+        '''
+        matcher = self.matcher()
+        frame = decodeFrame(data, matcher.preprocess)
+        located = matcher.forLocation('map/0', self.analyzer.indices[0])
+        located.setQueryImage(frame.query)
+        located.prepareQuery()
+        return frame.blur, located
+
+    def matchBatch(self, requests):
+        '''
+        Matches the frames of a batch against every location, returning
+        [totalMatches, probL] lists per location for each request.
+        '''
+        prepared = list(self.executor.map(lambda request: self.prepareFrame(request.data), requests))
+        numLocations = self.analyzer.numLocations
+
+        if self.method in ('Color', 'BOW', 'MapBOW') or self.analyzer.cascade is not None:
+            matches = [self.analyzer.matchLocations(matcher, range(numLocations)) for blur, matcher in prepared]
+            return [blur for blur, matcher in prepared], matches
+
+        descriptorSets = [matcher.getQueryFeatures()[1] for blur, matcher in prepared]
+        matches = [[] for request in requests]
+        for i in range(numLocations):
+            located = prepared[0][1].forLocation('map/' + str(i), self.analyzer.indices[i])
+            imagePaths = [located.data + '/angle' + str(angle).zfill(3) + extension for angle in range(0, 375, 15)]
+            for results, counts in zip(matches, located.matchImagesBatch(descriptorSets, imagePaths)):
+                totalMatches = sum(counts)
+                if totalMatches == 0:
+                    totalMatches = 1
+                results.append([totalMatches, [count/totalMatches for count in counts]])
+        return [blur for blur, matcher in prepared], matches
+
+    def processBatch(self, requests):
+        '''
+        Matches a batch and updates the belief of each request's session, in
+        arrival order. A request with reset set starts its session over. Runs
+        on a worker thread, one batch at a time.
+        '''
+        start = time.time()
+        blurFactors, matches = self.matchBatch(requests)
+        responses = []
+        for request, blurFactor, results in zip(requests, blurFactors, matches):
+            with self.sessionsLock:
+                session = None if request.reset else self.sessions.get(request.session)
+                if session is None:
+                    session = Session(self.analyzer.numLocations, self.analyzer.numAngles)
+                    self.sessions[request.session] = session
+                session.lastSeen = time.time()
+
+            p = belief.Belief.fromList(results)
+            actionAccount = self.analyzer.accountCommand(request.command, session.belief)
+            adjusted = self.analyzer.prevWeight(actionAccount, p)
+            session.belief = self.analyzer.probUpdate(actionAccount, adjusted, blurFactor)
+            bestCircleIndex, bestAngleIndex = session.belief.best()
+
+            responses.append({'session': request.session, 'location': bestCircleIndex, 'angle': bestAngleIndex,
+                              'blur': blurFactor, 'batch': len(requests), 'matching': time.time() - start,
+                              'latency': time.time() - request.received})
+        return responses
+
+    def expireSessions(self):
+        now = time.time()
+        with self.sessionsLock:
+            expired = [name for name, session in self.sessions.items() if now - session.lastSeen > self.sessionTimeout]
+            for name in expired:
+                del self.sessions[name]
+
+    ###############
+    ### Serving ###
+    ###############
+
+    async def batcher(self):
+        '''
+        Collects requests into batches within the batching window and
+        processes them one batch at a time.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(requests) < self.maxBatch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                responses = await loop.run_in_executor(None, self.processBatch, requests)
+                for request, response in zip(requests, responses):
+                    request.future.set_result(response)
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+            self.expireSessions()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                header = await readMessage(reader)
+                if header is None:
+                    break
+                data = await reader.readexactly(header['size'])
+                future = loop.create_future()
+                await self.queue.put(Request(header['session'], header.get('command', 's'), data, future,
+                                             bool(header.get('reset'))))
+                try:
+                    writeMessage(writer, await future)
+                except Exception as e:
+                    writeMessage(writer, {'session': header['session'], 'error': str(e)})
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        '''
+        Serves on a Unix socket if a path is given, otherwise on TCP.
+        '''
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print('Serving %s on %s' % (self.method, path or '%s:%d' % (host, port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+######################
+### Load Generator ###
+######################
+
+async def connect(host='127.0.0.1', port=8765, path=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+async def robot(name, frames, commands, latencies, host, port, path):
+    '''
+    Sends frames one after the other as a single robot would, recording the
+    round-trip time of each.
+    '''
+    reader, writer = await connect(host, port, path)
+    for i, (data, command) in enumerate(zip(frames, commands)):
+        start = time.time()
+        writeMessage(writer, {'session': name, 'command': command, 'size': len(data), 'reset': i == 0})
+        writer.write(data)
+        await writer.drain()
+        response = await readMessage(reader)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        latencies.append(time.time() - start)
+    writer.close()
+
+async def loadTest(robots=4, numFrames=24, host='127.0.0.1', port=8765, path=None, source='cam1_img'):
+    '''
+    Replays the frames of source from several concurrent robots and returns
+    the throughput in frames per second and the round-trip latencies.
+    '''
+    imagePaths = sorted(glob.glob(source + '/*' + extension))
+    frames = [open(imagePath, 'rb').read() for imagePath in imagePaths]
+    frames = [frames[i % len(frames)] for i in range(numFrames)]
+    commands = ['s'] * numFrames
+
+    latencies = []
+    start = time.time()
+    await asyncio.gather(*[robot('robot%d' % i, frames, commands, latencies, host, port, path) for i in range(robots)])
+    elapsed = time.time() - start
+    return len(latencies) / elapsed, latencies
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('mode', choices=['serve', 'load'])
+    ap.add_argument('-a', '--algorithm', default='SIFT', help='Matching algorithm')
+    ap.add_argument('-p', '--port', type=int, default=8765)
+    ap.add_argument('-u', '--unix', default=None, help='Path of a Unix socket to use instead of TCP')
+    ap.add_argument('-w', '--window', type=float, default=10, help='Batching window in milliseconds')
+    ap.add_argument('-b', '--budget', type=int, default=None, help='Keypoint budget per image')
+    ap.add_argument('-g', '--grid', type=int, default=None, help='Cells per side of the budget grid')
+    ap.add_argument('-v', '--vote', action='store_true', help='Match with one FLANN index per location')
+    ap.add_argument('-r', '--robots', type=int, default=4, help='Concurrent robots of the load generator')
+    ap.add_argument('-n', '--frames', type=int, default=24, help='Frames sent by each robot')
+    args = vars(ap.parse_args())
+
+    if args['mode'] == 'serve':
+        server = LocalizationServer(args['algorithm'], vote=args['vote'], window=args['window'] / 1000.,
+                                    budget=args['budget'], grid=args['grid'])
+        asyncio.run(server.serve(port=args['port'], path=args['unix']))
+    else:
+        throughput, latencies = asyncio.run(loadTest(args['robots'], args['frames'], port=args['port'], path=args['unix']))
+        print('Throughput: %.1f frames/s' % throughput)
+        print('Latency: p50 %.0f ms, p99 %.0f ms' % (np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
@@ -0,0 +1,159 @@
+'''
+Filter Parameter Sweep
+======================
+
+Evaluates a grid of filter constants on a stored run without any
+image matching. The raw match results of createRawP (rawP.bin),
+the commands and the blur factors are loaded once, and every
+configuration of the grid is filtered at the same time: the belief
+of all configurations is one (configurations, locations, 1 + angles)
+array. Each configuration is scored with the metrics of error.py.
+
+The grid is split between processes to use several cores.
+
+Usage:
+------
+    python sweep.py -w 0.5,0.6,0.7,0.8 -t 100,200,300 -c 0.75,0.85,0.95 -f 0,0.05,0.1
+
+    Prints the best configurations by success rate.
+'''
+
+import glob
+import itertools
+import math
+import multiprocessing
+import numpy as np
+
+import belief
+import error
+import probStore
+from analyze import analyzer
+
+extension = '.png'
+parameters = ['currentWeight', 'threshold', 'cap', 'forwardFactor']
+
+
+def filterConfigurations(raw, commands, blurFactors, currentWeight, threshold, cap, forwardFactor):
+    '''
+    belief.filterSequence for many configurations at once. The parameters are
+    arrays with one value per configuration. Returns the (configurations,
+    frames, 2) best guesses and the (configurations, frames, angles)
+    probabilities of the best guessed locations.
+    '''
+    raw = np.asarray(raw, np.float64)
+    numFrames, numLocations, width = raw.shape
+    currentWeight, threshold, cap, forwardFactor = [np.asarray(p, np.float64)
+                                                    for p in (currentWeight, threshold, cap, forwardFactor)]
+    configs = np.arange(len(currentWeight))
+
+    state = np.empty((len(configs), numLocations, width))
+    state[:, :, 0] = 1
+    state[:, :, 1:] = 1/75
+    bestGuess = np.zeros((len(configs), numFrames, 2), int)
+    bestProbs = np.zeros((len(configs), numFrames, width - 1))
+
+    # accountCommand's forward factor of every angle, computed as it does
+    sines = np.array([abs(math.sin(angle*15 * 180/math.pi)) for angle in range(width - 1)])
+    cw = currentWeight[:, None, None]
+    best = belief.bestGuesses(state)
+
+    for t in range(numFrames):
+        command = commands[t]
+        shifted = state.copy()
+        if command == 'l':
+            shifted[:, :, 1:] = np.roll(state[:, :, 1:], -1, axis=2)
+        elif command == 'r':
+            shifted[:, :, 1:] = np.roll(state[:, :, 1:], 1, axis=2)
+        elif command == 'f':
+            bestCircleIndex, bestAngleIndex = best[:, 0], best[:, 1]
+            factor = forwardFactor * sines[bestAngleIndex]
+            forward = (bestCircleIndex < numLocations - 1) & (bestAngleIndex*15 < 180) & (bestAngleIndex > 0)
+            backward = ~forward & (bestCircleIndex > 0) & (bestAngleIndex*15 > 180) & (bestAngleIndex*15 < 360)
+            shifted[configs[forward], bestCircleIndex[forward] + 1, 0] *= (1 + factor[forward])
+            shifted[configs[backward], bestCircleIndex[backward] - 1, 0] *= (1 + factor[backward])
+
+        # prevWeight, then probUpdate with the blur weight of every configuration
+        adjusted = raw[t] * cw
+        adjusted += (1 - cw) * shifted
+        weights = np.where(blurFactors[t] > threshold, cap, (blurFactors[t] / threshold) * cap)[:, None, None]
+        state = adjusted * weights
+        state += (1 - weights) * shifted
+
+        best = belief.bestGuesses(state)
+        bestGuess[:, t] = best
+        bestProbs[:, t] = state[configs, best[:, 0], 1:]
+    return bestGuess, bestProbs
+
+def scoreConfigurations(args):
+    '''
+    Filters and scores a chunk of configurations; the pool worker.
+    '''
+    raw, commands, blurFactors, coordinates, grid = args
+    bestGuess, bestProbs = filterConfigurations(raw, commands, blurFactors, *grid.T)
+    return np.column_stack((error.successScores(bestGuess, coordinates),
+                            error.modalScores(bestGuess, coordinates),
+                            error.errorScores(bestProbs, coordinates)))
+
+def loadRun(rawPath='rawP.bin', commandPath='commands.txt', coordPath='coord.txt', source='cam1_img'):
+    '''
+    Loads the raw match results, commands, blur factors and true coordinates
+    of a run, with frames in the order processRaw handles them.
+    '''
+    loader = analyzer('Color', 0, 0)
+    rawP = probStore.readFrames(rawPath)
+    frames = list(loader.frames(glob.glob(source + '/*' + extension)))
+    names = [frame.path.replace(source + '/', '').replace(extension, '') for frame in frames]
+    raw = np.array(rawP[[int(name) for name in names]])
+    commands = loader.readCommand(commandPath)
+    return raw, [commands[name] for name in names], np.array([frame.blur for frame in frames]), error.readCoord(coordPath)
+
+def sweep(grid, run=None, workers=None, chunk=64):
+    '''
+    Scores every combination of the values in grid, a dictionary of parameter
+    name to values, on the run given by loadRun. Parameters that are left out
+    keep their default values. Returns the (configurations, 4) array of
+    parameter values and the (configurations, 3) array of success, modal and
+    error scores.
+    '''
+    if run is None:
+        run = loadRun()
+    defaults = {'currentWeight': [0.7], 'threshold': [200], 'cap': [0.85], 'forwardFactor': [0.05]}
+    values = [grid.get(name, defaults[name]) for name in parameters]
+    configurations = np.array(list(itertools.product(*values)), np.float64)
+
+    tasks = [run + (configurations[i:i+chunk],) for i in range(0, len(configurations), chunk)]
+    workers = workers or multiprocessing.cpu_count()
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            scores = pool.map(scoreConfigurations, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = [scoreConfigurations(task) for task in tasks]
+    return configurations, np.vstack(scores)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-w', '--weight', default='0.7', help='Values of the current weight of prevWeight')
+    ap.add_argument('-t', '--threshold', default='200', help='Values of the blur threshold of probUpdate')
+    ap.add_argument('-c', '--cap', default='0.85', help='Values of the blur weight cap of probUpdate')
+    ap.add_argument('-f', '--forward', default='0.05', help='Values of the forward factor of accountCommand')
+    ap.add_argument('-j', '--workers', type=int, default=None, help='Number of processes')
+    ap.add_argument('-n', '--top', type=int, default=10, help='Number of configurations to print')
+    args = vars(ap.parse_args())
+
+    grid = dict((name, list(map(float, args[key].split(','))))
+                for name, key in zip(parameters, ['weight', 'threshold', 'cap', 'forward']))
+    start = time.time()
+    configurations, scores = sweep(grid, workers=args['workers'])
+    print('Evaluated %d configurations in %0.1f s' % (len(configurations), time.time() - start))
+
+    print('%8s %10s %6s %8s | %8s %10s %12s' % ('weight', 'threshold', 'cap', 'forward', 'success', 'modal', 'error'))
+    for i in np.lexsort((scores[:, 2], -scores[:, 0]))[:args['top']]:
+        print('%8.3f %10.1f %6.3f %8.3f | %8.3f %10.1f %12.1f' % (tuple(configurations[i]) + tuple(scores[i])))